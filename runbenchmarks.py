@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""
+Benchmarks for the hot paths of the middleware, backend, views and context
+processors, run against the in-memory SQLite database of the test project.
+
+    python runbenchmarks.py [--output results.json] [--repeat 5] [name ...]
+
+Results are written as JSON, one entry per benchmark with the time per
+operation in microseconds and the number of queries per operation.
+"""
+
+# Future Imports
+from __future__ import absolute_import, division, unicode_literals
+
+# Standard Library Imports
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+from itertools import count
+
+# Third Party Library Imports
+import django
+from django.conf import settings
+
+
+def run_benchmarks(names, repeat, number):
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+    django.setup()
+
+    # Third Party Library Imports
+    from django.contrib.auth.middleware import AuthenticationMiddleware
+    from django.contrib.auth.models import Group, User
+    from django.contrib.sessions.middleware import SessionMiddleware
+    from django.core.signals import request_started
+    from django.db import connection, reset_queries
+    from django.template import RequestContext, Template
+    from django.test import Client, RequestFactory
+    from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment
+    from django.test.runner import DiscoverRunner
+
+    # First Party Library Imports
+    from shibauth_rit.compat import reverse
+    from shibauth_rit.middleware import ShibauthRitMiddleware
+
+    setup_test_environment()
+    # The test client would otherwise clear the captured queries on every request.
+    request_started.disconnect(reset_queries)
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+
+    factory = RequestFactory()
+    middleware = ShibauthRitMiddleware()
+    session_middleware = SessionMiddleware()
+    auth_middleware = AuthenticationMiddleware()
+    usernames = count()
+
+    def headers(username, groups=0):
+        meta = dict(settings.SAMPLE_HEADERS, uid=username)
+        meta['ritEduMemberOfUid'] = ';'.join('group%d' % i for i in range(groups))
+        return meta
+
+    def login_request(meta, session_key=None):
+        request = factory.get('/', **meta)
+        if session_key:
+            request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+        session_middleware.process_request(request)
+        auth_middleware.process_request(request)
+        middleware.process_request(request)
+        # Evaluate the lazy user and save the session like a response would.
+        request.user.is_authenticated()
+        request.session.save()
+        return request
+
+    def authenticated_fast_path():
+        meta = headers('fastpath')
+        session_key = login_request(meta).session.session_key
+        return lambda: login_request(meta, session_key)
+
+    def first_login(groups):
+        def setup():
+            # Create the groups once, new users usually join existing groups.
+            login_request(headers('setup%d' % groups, groups))
+            return lambda: login_request(headers('new%d' % next(usernames), groups))
+        return setup
+
+    def relogin_unchanged():
+        meta = headers('relogin', 10)
+        login_request(meta)
+        return lambda: login_request(meta)
+
+    def logout_flow():
+        client = Client()
+        login_url = reverse('shibauth_rit:shibauth_login')
+        logout_url = reverse('shibauth_rit:shibauth_logout')
+        meta = headers('logout')
+
+        def run():
+            client.get(login_url, **meta)
+            client.get(logout_url, **meta)
+        return run
+
+    def context_processors():
+        template = Template('{{ login_link }} {{ logout_link }}')
+        request = factory.get('/some/page/?with=query')
+        return lambda: template.render(RequestContext(request, {}))
+
+    benchmarks = [
+        ('middleware.authenticated_fast_path', authenticated_fast_path),
+        ('middleware.first_login_0_groups', first_login(0)),
+        ('middleware.first_login_10_groups', first_login(10)),
+        ('middleware.first_login_100_groups', first_login(100)),
+        ('middleware.relogin_unchanged', relogin_unchanged),
+        ('views.logout_flow', logout_flow),
+        ('context_processors.render', context_processors),
+    ]
+
+    results = []
+    overrides = override_settings(
+        SHIBAUTH_ATTRIBUTE_MAP={
+            'uid': (True, 'username'),
+            'mail': (False, 'email'),
+            'givenName': (False, 'first_name'),
+            'sn': (False, 'last_name'),
+        },
+        SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'],
+        SHIBAUTH_LOGOUT_NOTIFY_URL=None,
+    )
+    overrides.enable()
+    try:
+        for name, setup in benchmarks:
+            if names and name not in names:
+                continue
+            func = setup()
+            with CaptureQueriesContext(connection) as queries:
+                func()
+            query_count = len(queries)
+            timings = timeit.repeat(func, repeat=repeat, number=number)
+            per_op = sorted(t / number * 1e6 for t in timings)
+            results.append({
+                'name': name,
+                'repeat': repeat,
+                'number': number,
+                'min_us': round(per_op[0], 1),
+                'median_us': round(per_op[len(per_op) // 2], 1),
+                'max_us': round(per_op[-1], 1),
+                'queries': query_count,
+            })
+            sys.stderr.write('%-45s %10.1f us %4d queries\n' % (name, per_op[0], query_count))
+        results = {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'users': User.objects.count(),
+            'groups': Group.objects.count(),
+            'benchmarks': results,
+        }
+    finally:
+        overrides.disable()
+        runner.teardown_databases(old_config)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark django-shibauth-rit.')
+    parser.add_argument('names', nargs='*', help='only run these benchmarks')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timing runs')
+    parser.add_argument('--number', type=int, default=50, help='operations per timing run')
+    args = parser.parse_args()
+    results = run_benchmarks(args.names, args.repeat, args.number)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
@@ -1 +1,3 @@
 __version__ = '1.1.0'
+
+default_app_config = 'shibauth_rit.apps.ShibauthRitConfig'
@@ -2,7 +2,51 @@
 
 # Third Party Library Imports
 from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save
 
 
 class ShibauthRitConfig(AppConfig):
     name = 'shibauth_rit'
+
+    def ready(self):
+        # Third Party Library Imports
+        from django.contrib.auth.models import Group, Permission
+
+        # Local Imports
+        from .attributes import get_attribute_plan, reset_attribute_plan
+        from .cache import invalidate_cached_user, reset_user_cache
+        from .context_processors import reset_reversed_urls
+        from .groups import check_group_catalog, discard_cataloged_group, reset_group_catalog
+        from .instrumentation import connect_exporters, reset_exporters
+        from .notifier import reset_logout_notifier
+        from .paths import reset_path_matchers
+        from .permissions import bump_membership_version, bump_permissions_version, check_permission_snapshot
+        from .profiles import reset_profile_executor
+
+        setting_changed.connect(reset_attribute_plan)
+        setting_changed.connect(reset_logout_notifier)
+        setting_changed.connect(reset_user_cache)
+        setting_changed.connect(reset_exporters)
+        setting_changed.connect(reset_group_catalog)
+        setting_changed.connect(reset_path_matchers)
+        setting_changed.connect(reset_reversed_urls)
+        setting_changed.connect(reset_profile_executor)
+        User = get_user_model()
+        post_save.connect(invalidate_cached_user, sender=User)
+        post_delete.connect(invalidate_cached_user, sender=User)
+        post_save.connect(discard_cataloged_group, sender=Group)
+        post_delete.connect(discard_cataloged_group, sender=Group)
+        for model in (Group, Permission):
+            post_save.connect(bump_permissions_version, sender=model)
+            post_delete.connect(bump_permissions_version, sender=model)
+        m2m_changed.connect(bump_permissions_version, sender=Group.permissions.through)
+        # Custom user models don't have to use PermissionsMixin.
+        for name in ('groups', 'user_permissions'):
+            if hasattr(User, name):
+                m2m_changed.connect(bump_membership_version, sender=getattr(User, name).through)
+        check_permission_snapshot()
+        check_group_catalog()
+        get_attribute_plan()
+        connect_exporters()
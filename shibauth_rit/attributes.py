@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import re
+from collections import namedtuple
+
+# Third Party Library Imports
+from django.contrib.auth import get_user_model
+
+# First Party Library Imports
+from shibauth_rit.compat import MappingProxyType
+from shibauth_rit.conf import settings
+from shibauth_rit.utils import fingerprint
+
+AttributePlan = namedtuple('AttributePlan', [
+    'attribute_map',    # the SHIBAUTH_ATTRIBUTE_MAP the plan was compiled from
+    'headers',          # (header, name, required) for every mapped attribute
+    'required_fields',  # names of required attributes that are concrete User fields
+    'optional_fields',  # names of optional attributes that are concrete User fields
+])
+
+ShibbolethAttributes = namedtuple('ShibbolethAttributes', [
+    'meta',    # read-only {name: (value, required)} of the mapped attributes that are present
+    'groups',  # frozenset of the group names in the SHIBAUTH_GROUP_ATTRIBUTES
+    'error',   # True if a required attribute is missing
+])
+
+_attribute_plan = None
+
+
+def compile_attribute_plan(attribute_map):
+    """
+    Turn a ``SHIBAUTH_ATTRIBUTE_MAP`` into an ``AttributePlan``.
+    """
+    headers = tuple((header, name, required) for header, (required, name) in attribute_map.items())
+    user_fields = set(field.name for field in get_user_model()._meta.concrete_fields)
+    return AttributePlan(
+        attribute_map=attribute_map,
+        headers=headers,
+        required_fields=tuple(name for _, name, required in headers if required and name in user_fields),
+        optional_fields=tuple(name for _, name, required in headers if not required and name in user_fields),
+    )
+
+
+def get_attribute_plan():
+    """
+    Return the ``AttributePlan`` for the current ``SHIBAUTH_ATTRIBUTE_MAP``,
+    compiling it only when the setting has changed.
+    """
+    global _attribute_plan
+    attribute_map = getattr(settings, "SHIBAUTH_ATTRIBUTE_MAP")
+    # Settings assigned directly instead of through override_settings don't
+    # send setting_changed, so make sure the plan belongs to the current map.
+    if _attribute_plan is None or _attribute_plan.attribute_map is not attribute_map:
+        _attribute_plan = compile_attribute_plan(attribute_map)
+    return _attribute_plan
+
+
+def reset_attribute_plan(setting, **kwargs):
+    """
+    ``setting_changed`` receiver throwing away the compiled plan.
+    """
+    global _attribute_plan
+    if setting in ('SHIBAUTH_ATTRIBUTE_MAP', 'AUTH_USER_MODEL'):
+        _attribute_plan = None
+
+
+def get_username_attribute():
+    """
+    Return the attribute mapped to the username field, falling back to
+    ``SHIBAUTH_REMOTE_USER_HEADER``.  Unlike the header set by the web server
+    it's part of the attributes released by the identity provider.
+    """
+    username_field = get_user_model().USERNAME_FIELD
+    for header, name, _ in get_attribute_plan().headers:
+        if name == username_field:
+            return header
+    return getattr(settings, "SHIBAUTH_REMOTE_USER_HEADER")
+
+
+def attributes_fingerprint(shib_meta):
+    """
+    Return a stable hash of parsed Shibboleth attributes.
+    """
+    return fingerprint(u'%s=%s' % (name, value) for name, (value, required) in shib_meta.items())
+
+
+def split_values(value, delimiter=';'):
+    """
+    Split a multi-valued attribute on ``delimiter``, unless it's escaped with
+    a backslash like the Shibboleth SP does for values holding a ``;``.
+    """
+    if '\\' not in value:
+        return value.split(delimiter)
+    escaped = '\\' + delimiter
+    return [part.replace(escaped, delimiter) for part in re.split(r'(?<!\\)' + re.escape(delimiter), value)]
+
+
+def parse_headers(meta):
+    """
+    Parse the mapped attributes and the groups out of ``meta``, a
+    ``request.META`` like dict, in a single pass over the configured headers.
+    """
+    shib_attrs = {}
+    error = False
+    for header, name, required in get_attribute_plan().headers:
+        value = meta.get(header, None)
+        if value:
+            shib_attrs[name] = (value, required)
+        else:
+            shib_attrs.pop(name, None)
+            if required:
+                error = True
+    groups = set()
+    delimiter = getattr(settings, "SHIBAUTH_GROUP_DELIMITER")
+    for attr in getattr(settings, "SHIBAUTH_GROUP_ATTRIBUTES"):
+        value = meta.get(attr)
+        if value:
+            groups.update(split_values(value, delimiter))
+    groups.discard('')
+    return ShibbolethAttributes(meta=MappingProxyType(shib_attrs), groups=frozenset(groups), error=error)
+
+
+def parse_request(request):
+    """
+    Return the ``ShibbolethAttributes`` of the request, parsing its headers only
+    the first time.
+    """
+    attributes = getattr(request, '_shibauth_attributes', None)
+    if attributes is None:
+        attributes = request._shibauth_attributes = parse_headers(request.META)
+    return attributes
@@ -2,15 +2,52 @@
 
 # Third Party Library Imports
 from django.contrib.auth import get_user_model
-from django.contrib.auth.backends import RemoteUserBackend
+from django.contrib.auth.backends import ModelBackend, RemoteUserBackend
+from django.db import connections, router
+from django.db.models.signals import post_save, pre_save
 
 # First Party Library Imports
+from shibauth_rit.attributes import attributes_fingerprint, get_attribute_plan
+from shibauth_rit.cache import get_cached_user, get_user_caches
+from shibauth_rit.compat import supports_upsert
 from shibauth_rit.conf import settings
 
 User = get_user_model()
 
 
-class ShibauthRitBackend(RemoteUserBackend):
+class PermissionSnapshotMixin(object):
+    """
+    Answers permission checks from the snapshot that ``ShibauthRitMiddleware``
+    attaches to ``request.user`` when ``SHIBAUTH_PERMISSION_SNAPSHOT`` is set,
+    instead of querying the group and permission tables on every request.
+    """
+
+    def get_user_permissions(self, user_obj, obj=None):
+        snapshot = self._get_snapshot(user_obj, obj)
+        if snapshot is None:
+            return super(PermissionSnapshotMixin, self).get_user_permissions(user_obj, obj)
+        return set(snapshot.user_permissions)
+
+    def get_group_permissions(self, user_obj, obj=None):
+        snapshot = self._get_snapshot(user_obj, obj)
+        if snapshot is None:
+            return super(PermissionSnapshotMixin, self).get_group_permissions(user_obj, obj)
+        return set(snapshot.group_permissions)
+
+    def get_all_permissions(self, user_obj, obj=None):
+        snapshot = self._get_snapshot(user_obj, obj)
+        if snapshot is None:
+            return super(PermissionSnapshotMixin, self).get_all_permissions(user_obj, obj)
+        return snapshot.user_permissions | snapshot.group_permissions
+
+    @staticmethod
+    def _get_snapshot(user_obj, obj):
+        if obj is not None or not user_obj.is_active:
+            return None
+        return getattr(user_obj, '_shibauth_permissions', None)
+
+
+class ShibauthRitBackend(PermissionSnapshotMixin, RemoteUserBackend):
     """
     This backend is to be used in conjunction with the ``RemoteUserMiddleware``
     found in the middleware module of this package, and is used when the server
@@ -19,6 +56,19 @@ class ShibauthRitBackend(RemoteUserBackend):
     By default, the ``authenticate`` method creates ``User`` objects for
     usernames that don't already exist in the database.  Disable this
     behavior by setting ``SHIBAUTH_CREATEUNKNOWN_USER`` to ``False``.
+
+    Set ``SHIBAUTH_USER_CACHE_SIZE`` to keep that many resolved users in memory
+    for ``SHIBAUTH_USER_CACHE_TIMEOUT`` seconds, skipping the database while
+    their Shibboleth attributes stay the same.  Set ``SHIBAUTH_SHARED_USER_CACHE``
+    to share them between processes through the ``SHIBAUTH_CACHE_ALIAS``
+    Django cache as well.
+
+    Set ``SHIBAUTH_READ_DATABASE`` to look existing users up on a replica, the
+    primary is then only used to create users and to save changed attributes.
+
+    Set ``SHIBAUTH_UPSERT_USERS`` to create new users with a single
+    ``INSERT ... ON CONFLICT DO NOTHING`` on PostgreSQL and SQLite, which doesn't
+    fail when several requests log the same new user in at once.
     """
     create_unknown_user = getattr(settings, "SHIBAUTH_CREATE_UNKNOWN_USER", True)
 
@@ -34,49 +84,155 @@ class ShibauthRitBackend(RemoteUserBackend):
         if not remote_user:
             return
         username = self.clean_username(remote_user)
-        field_names = [x.name for x in User._meta.get_fields()]
-        required_kwargs = {}
-        non_required_kwargs = {}
-        for field in field_names:
-            if field in shib_meta:
-                meta, required = shib_meta[field]
-                if required:
-                    required_kwargs[field] = meta
-                else:
-                    non_required_kwargs[field] = meta
+        user_caches = get_user_caches()
+        if user_caches:
+            fingerprint = attributes_fingerprint(shib_meta)
+            user = get_cached_user(user_caches, username, fingerprint)
+            if user is not None:
+                # The shared cache leaves the attributes out, they're the ones in shib_meta.
+                deferred = user.get_deferred_fields()
+                for field in get_attribute_plan().optional_fields:
+                    if field in deferred and field in shib_meta:
+                        setattr(user, field, shib_meta[field][0])
+                return user if self.user_can_authenticate(user) else None
+        plan = get_attribute_plan()
+        required_kwargs = dict((field, shib_meta[field][0]) for field in plan.required_fields if field in shib_meta)
+        non_required_kwargs = dict(
+            (field, shib_meta[field][0]) for field in plan.optional_fields if field in shib_meta)
+        # Most logins are of existing users, look them up on the replica first.
+        user = self.get_replica_user(username)
         # Note that this could be accomplished in one try-except clause, but
         # instead we use get_or_create when creating users since it has
         # built-in safeguards for multiple threads.
-        if self.create_unknown_user:
+        if user is None and self.create_unknown_user:
             required_kwargs[User.USERNAME_FIELD] = username
-            user, created = User._default_manager.get_or_create(**required_kwargs)
-            if created:
-                """
-                @note: setting password for user needs on initial creation of user instead
-                of after auth.login() of middleware. Because get_session_auth_hash() returns the
-                salted_hmac value of salt and password. If it remains after the auth.login() it
-                will return a different auth_hash than what's stored in session
-                "request.session[HASH_SESSION_KEY]". Also we don't need to update the
-                user's password everytime he logs in.
-                """
-                user.set_unusable_password()
-                user.is_active = True
-                user.save()
-                user = self.configure_user(user)
-        else:
+            if self.can_upsert():
+                user = self.get_or_upsert_user(dict(non_required_kwargs, **required_kwargs))
+            else:
+                user, created = User._default_manager.get_or_create(**required_kwargs)
+                if created:
+                    """
+                    @note: setting password for user needs on initial creation of user instead
+                    of after auth.login() of middleware. Because get_session_auth_hash() returns the
+                    salted_hmac value of salt and password. If it remains after the auth.login() it
+                    will return a different auth_hash than what's stored in session
+                    "request.session[HASH_SESSION_KEY]". Also we don't need to update the
+                    user's password everytime he logs in.
+                    """
+                    user.set_unusable_password()
+                    user.is_active = True
+                    # Store the attributes right away so they don't cost another save below.
+                    for field, value in non_required_kwargs.items():
+                        setattr(user, field, value)
+                    user.save()
+                    user = self.configure_user(user)
+        elif user is None:
             try:
                 user = User._default_manager.get_by_natural_key(username)
             except User.DoesNotExist:
                 user = None
         # After receiving a valid user, we update the the user attributes according to the shibboleth
         # parameters. Otherwise the parameters (like mail address, sure_name or last_name) will always
-        # be the initial values from the first login. Only save user object if there are any changes.
+        # be the initial values from the first login. Only the changed fields are written and
+        # nothing is written at all if the attributes are unchanged.
         if user:
-            if [getattr(user, k) == v for k, v in non_required_kwargs.items()]:
-                user.__dict__.update(**non_required_kwargs)
-                user.save()
+            changed_fields = [k for k, v in non_required_kwargs.items() if getattr(user, k) != v]
+            if changed_fields:
+                for field in changed_fields:
+                    setattr(user, field, non_required_kwargs[field])
+                user.save(update_fields=changed_fields)
+            for user_cache in user_caches:
+                user_cache.set(username, fingerprint, user)
         return user if self.user_can_authenticate(user) else None
 
+    def get_replica_user(self, username):
+        """
+        Return the user from the ``SHIBAUTH_READ_DATABASE`` replica, bound to
+        the database users are written to so saving it goes to the primary, or
+        None if there is no replica or the user isn't on it, e.g. because it was
+        created too recently to be replicated.
+
+        The replica may lag behind, so a user deactivated on the primary can
+        log in until it catches up.  With ``SHIBAUTH_READ_DATABASE_CHECK_ACTIVE``
+        ``is_active`` is read from the primary instead, at the cost of a query.
+        """
+        alias = getattr(settings, "SHIBAUTH_READ_DATABASE")
+        if not alias:
+            return None
+        try:
+            user = User._default_manager.db_manager(alias).get_by_natural_key(username)
+        except User.DoesNotExist:
+            return None
+        user._state.db = router.db_for_write(User)
+        if getattr(settings, "SHIBAUTH_READ_DATABASE_CHECK_ACTIVE") and any(
+                field.name == 'is_active' for field in User._meta.concrete_fields):
+            primary = User._default_manager.db_manager(user._state.db).filter(pk=user.pk)
+            is_active = primary.values_list('is_active', flat=True).first()
+            if is_active is None:
+                # Deleted on the primary.
+                return None
+            user.is_active = is_active
+        return user
+
+    def can_upsert(self):
+        """
+        Whether new users can be created with ``upsert_user``, which only writes
+        the user's own table and so doesn't support multi-table inheritance.
+        """
+        if not getattr(settings, "SHIBAUTH_UPSERT_USERS") or User._meta.parents:
+            return False
+        return supports_upsert(connections[router.db_for_write(User)])
+
+    def get_or_upsert_user(self, attributes):
+        """
+        Return the existing user, or create it with ``attributes`` using
+        ``upsert_user``.
+        """
+        try:
+            return User._default_manager.get_by_natural_key(attributes[User.USERNAME_FIELD])
+        except User.DoesNotExist:
+            pass
+        user, created = self.upsert_user(attributes)
+        return self.configure_user(user) if created else user
+
+    def upsert_user(self, attributes):
+        """
+        Create the user with ``attributes`` in a single
+        ``INSERT ... ON CONFLICT DO NOTHING ... RETURNING`` statement.  If a
+        concurrent login created the user first nothing is returned, and the
+        existing user is fetched instead; ``authenticate`` then updates its
+        attributes.  Returns ``(user, created)``.
+        """
+        db = router.db_for_write(User)
+        connection = connections[db]
+        opts = User._meta
+        qn = connection.ops.quote_name
+        user = User(**attributes)
+        # See the note in authenticate.
+        user.set_unusable_password()
+        user.is_active = True
+        pre_save.send(sender=User, instance=user, raw=False, using=db, update_fields=None)
+        fields = [field for field in opts.local_concrete_fields if field is not opts.auto_field]
+        values = [field.get_db_prep_save(field.pre_save(user, True), connection=connection) for field in fields]
+        sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO NOTHING RETURNING %s' % (
+            qn(opts.db_table),
+            ', '.join(qn(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)),
+            qn(opts.get_field(User.USERNAME_FIELD).column),
+            qn(opts.pk.column),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, values)
+            row = cursor.fetchone()
+        if row is None:
+            username = attributes[User.USERNAME_FIELD]
+            return User._default_manager.db_manager(db).get(**{User.USERNAME_FIELD: username}), False
+        user.pk = row[0]
+        user._state.adding = False
+        user._state.db = db
+        post_save.send(sender=User, instance=user, created=True, update_fields=None, raw=False, using=db)
+        return user, True
+
     def user_can_authenticate(self, user):
         """
         Reject users with is_active=False. Custom user models that don't have
@@ -84,3 +240,10 @@ class ShibauthRitBackend(RemoteUserBackend):
         """
         is_active = getattr(user, 'is_active', None)
         return is_active or is_active is None
+
+
+class ShibauthRitPermissionBackend(PermissionSnapshotMixin, ModelBackend):
+    """
+    A ``ModelBackend`` using the permission snapshot, for projects keeping it
+    next to ``ShibauthRitBackend`` in ``AUTHENTICATION_BACKENDS``.
+    """
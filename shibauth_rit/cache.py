@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import threading
+from collections import OrderedDict
+
+# Third Party Library Imports
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+
+# First Party Library Imports
+from shibauth_rit.conf import settings
+from shibauth_rit.utils import fingerprint
+
+# Local Imports
+from .compat import model_from_db, monotonic
+
+_user_cache = None
+_user_cache_lock = threading.Lock()
+
+
+class UserCache(object):
+    """
+    A bounded, least recently used cache of the users resolved by the backend,
+    keyed by username and the fingerprint of their Shibboleth attributes.
+
+    Only the loaded column values are stored and every hit builds a new
+    ``User``, so requests never share an instance.
+    """
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # username -> (expires, fingerprint, db, values, field names)
+        self._usernames = {}  # pk -> username
+        self._lock = threading.Lock()
+
+    def get(self, username, attributes_fingerprint):
+        """
+        Return the cached user or None.
+        """
+        with self._lock:
+            entry = self._entries.pop(username, None)
+            if entry is None or entry[1] != attributes_fingerprint or entry[0] <= monotonic():
+                self.misses += 1
+                if entry is not None:
+                    self._usernames.pop(entry[3][0], None)
+                return None
+            # Move the entry to the most recently used end.
+            self._entries[username] = entry
+            self.hits += 1
+        return model_from_db(get_user_model(), entry[2], entry[4], entry[3])
+
+    def set(self, username, attributes_fingerprint, user):
+        field_names, values = _loaded_values(user, self._field_names(get_user_model()))
+        entry = (monotonic() + self.timeout, attributes_fingerprint, user._state.db, values, field_names)
+        with self._lock:
+            old = self._entries.pop(username, None)
+            if old is not None:
+                self._usernames.pop(old[3][0], None)
+            self._discard(user.pk)
+            self._entries[username] = entry
+            self._usernames[user.pk] = username
+            while len(self._entries) > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._usernames.pop(evicted[3][0], None)
+                self.evictions += 1
+
+    def invalidate(self, pk):
+        with self._lock:
+            self._discard(pk)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._usernames.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _discard(self, pk):
+        username = self._usernames.pop(pk, None)
+        if username is not None:
+            self._entries.pop(username, None)
+
+    @staticmethod
+    def _field_names(User):
+        # The primary key comes first, invalidation relies on it.
+        pk_name = User._meta.pk.attname
+        return [pk_name] + [f.attname for f in User._meta.concrete_fields if f.attname != pk_name]
+
+
+class SharedUserCache(object):
+    """
+    The ``UserCache`` counterpart backed by a Django cache, so every process
+    using the same cache shares the resolved users.
+
+    Entries carry the generation they were stored under and bumping the
+    generation with ``invalidate_all`` makes all of them stale at once.  A hit
+    costs a single ``get_many``.
+
+    Besides the primary key and the username only the ``fields`` columns are
+    stored, never the password hash or personal details.  The backend takes
+    the attributes from the Shibboleth headers and other columns are loaded
+    from the database when they're read.
+    """
+    generation_key = 'shibauth_rit:users:generation'
+    fields = ('is_active', 'is_staff', 'is_superuser')
+
+    def __init__(self, cache, timeout):
+        self.cache = cache
+        self.timeout = timeout
+
+    def get(self, username, attributes_fingerprint):
+        key = self._user_key(username)
+        values = self.cache.get_many([key, self.generation_key])
+        entry = values.get(key)
+        if entry is None or entry[:2] != (values.get(self.generation_key), attributes_fingerprint):
+            return None
+        return model_from_db(get_user_model(), entry[2], entry[4], entry[3])
+
+    def set(self, username, attributes_fingerprint, user):
+        generation = self.cache.get(self.generation_key)
+        if generation is None:
+            self.cache.add(self.generation_key, 1, None)
+            generation = self.cache.get(self.generation_key)
+        field_names, values = _loaded_values(user, self._field_names(get_user_model()))
+        key = self._user_key(username)
+        self.cache.set_many({
+            key: (generation, attributes_fingerprint, user._state.db, values, field_names),
+            self._pk_key(user.pk): key,
+        }, self.timeout)
+
+    def invalidate(self, pk):
+        pk_key = self._pk_key(pk)
+        key = self.cache.get(pk_key)
+        self.cache.delete_many([pk_key] + ([key] if key else []))
+
+    def invalidate_all(self):
+        try:
+            self.cache.incr(self.generation_key)
+        except ValueError:
+            # There is no generation yet, so nothing to invalidate.
+            pass
+
+    def _field_names(self, User):
+        names = [User._meta.pk.attname, User._meta.get_field(User.USERNAME_FIELD).attname]
+        return names + [f.attname for f in User._meta.concrete_fields if f.name in self.fields]
+
+    @staticmethod
+    def _user_key(username):
+        # Hash the username so it's safe to use with memcached.
+        return 'shibauth_rit:user:%s' % fingerprint([username])
+
+    @staticmethod
+    def _pk_key(pk):
+        return 'shibauth_rit:user_pk:%s' % pk
+
+
+def _loaded_values(user, field_names):
+    """
+    Return the ``field_names`` loaded on ``user`` and their values, leaving out
+    deferred fields so they aren't loaded just to be cached.
+    """
+    deferred = user.get_deferred_fields()
+    field_names = tuple(name for name in field_names if name not in deferred)
+    return field_names, tuple(getattr(user, name) for name in field_names)
+
+
+def get_user_cache():
+    """
+    Return the process wide ``UserCache``, or None if ``SHIBAUTH_USER_CACHE_SIZE``
+    is 0.
+    """
+    global _user_cache
+    max_size = getattr(settings, "SHIBAUTH_USER_CACHE_SIZE")
+    if not max_size:
+        return None
+    if _user_cache is None:
+        with _user_cache_lock:
+            if _user_cache is None:
+                _user_cache = UserCache(max_size, getattr(settings, "SHIBAUTH_USER_CACHE_TIMEOUT"))
+    return _user_cache
+
+
+def get_shared_user_cache():
+    """
+    Return a ``SharedUserCache`` using the ``SHIBAUTH_CACHE_ALIAS`` cache, or None
+    if ``SHIBAUTH_SHARED_USER_CACHE`` is off or there is no such cache.
+    """
+    alias = getattr(settings, "SHIBAUTH_CACHE_ALIAS")
+    if alias is None or not getattr(settings, "SHIBAUTH_SHARED_USER_CACHE"):
+        return None
+    return SharedUserCache(caches[alias], getattr(settings, "SHIBAUTH_USER_CACHE_TIMEOUT"))
+
+
+def get_user_caches():
+    """
+    Return the enabled user caches, fastest first.
+    """
+    return [cache for cache in (get_user_cache(), get_shared_user_cache()) if cache is not None]
+
+
+def get_cached_user(user_caches, username, attributes_fingerprint):
+    """
+    Look the user up in ``user_caches`` in order, copying a hit into the faster
+    caches that missed.
+    """
+    for i, user_cache in enumerate(user_caches):
+        user = user_cache.get(username, attributes_fingerprint)
+        if user is not None:
+            for faster_cache in user_caches[:i]:
+                faster_cache.set(username, attributes_fingerprint, user)
+            return user
+    return None
+
+
+def reset_user_cache(setting, **kwargs):
+    """
+    ``setting_changed`` receiver throwing away the cache.
+    """
+    global _user_cache
+    if setting.startswith('SHIBAUTH_USER_CACHE_') or setting == 'AUTH_USER_MODEL':
+        _user_cache = None
+
+
+def invalidate_cached_user(sender, instance, update_fields=None, **kwargs):
+    """
+    ``post_save`` and ``post_delete`` receiver removing a changed user from
+    the caches.  Saves that only touch ``last_login``, like the one made by
+    ``auth.login``, are ignored.
+    """
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    for user_cache in (_user_cache, get_shared_user_cache()):
+        if user_cache is not None:
+            user_cache.invalidate(instance.pk)
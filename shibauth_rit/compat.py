@@ -1,4 +1,75 @@
 try:
-    from django.urls import reverse, reverse_lazy  # noqa; F401
+    from django.urls import get_script_prefix, get_urlconf, reverse, reverse_lazy  # noqa; F401
 except ImportError:
-    from django.core.urlresolvers import reverse, reverse_lazy  # noqa; F401
+    from django.core.urlresolvers import get_script_prefix, get_urlconf, reverse, reverse_lazy  # noqa; F401
+
+# Third Party Library Imports
+import django
+from django.db import transaction
+
+# ``bulk_create(ignore_conflicts=True)`` was added in Django 2.2.
+bulk_create_ignores_conflicts = django.VERSION >= (2, 2)
+
+# ``bulk_update`` was added in Django 2.2 as well.
+has_bulk_update = django.VERSION >= (2, 2)
+
+# ``connection.execute_wrapper`` was added in Django 2.0, which is Python 3 only.
+has_execute_wrapper = django.VERSION >= (2, 0)
+
+try:
+    from contextlib import ExitStack  # noqa; F401
+except ImportError:  # Python 2
+    ExitStack = None
+
+try:
+    from time import monotonic  # noqa; F401
+except ImportError:  # Python 2
+    from time import time as monotonic  # noqa; F401
+
+try:
+    from types import MappingProxyType  # noqa; F401
+except ImportError:  # Python 2, where a copy has to do
+    MappingProxyType = dict
+
+try:
+    from django.utils.deprecation import MiddlewareMixin  # noqa; F401
+except ImportError:  # Django < 1.10
+    class MiddlewareMixin(object):
+
+        def __init__(self, get_response=None):
+            self.get_response = get_response
+
+
+def on_commit(func, using=None):
+    """
+    ``transaction.on_commit``, which Django 1.8 lacks: there ``func`` is called
+    right away.
+    """
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func, using=using)
+    else:
+        func()
+
+
+def model_from_db(model, db, field_names, values):
+    """
+    ``Model.from_db`` for only some of the columns, the others are deferred.
+    Before Django 1.10 that takes a deferred model class.
+    """
+    if django.VERSION < (1, 10):
+        from django.db.models.query_utils import deferred_class_factory
+        deferred = set(f.attname for f in model._meta.concrete_fields) - set(field_names)
+        if deferred:
+            model = deferred_class_factory(model, deferred)
+    return model.from_db(db, field_names, values)
+
+
+def supports_upsert(connection):
+    """
+    Whether the database can run ``INSERT ... ON CONFLICT DO NOTHING ... RETURNING``.
+    """
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+    return False
@@ -7,6 +7,7 @@ from django.core.exceptions import ImproperlyConfigured
 
 
 class ShibauthRitConf(AppConf):
+    ATOMIC_LOGIN = getattr(settings, "SHIBAUTH_ATOMIC_LOGIN", False)
     ATTRIBUTE_MAP = {
         "uid": (True, "username"),
         "mail": (False, "email"),
@@ -16,14 +17,39 @@ class ShibauthRitConf(AppConf):
         "ritEduMemberOfUid": (False, "account_group"),
         "ritEduAffiliation": (False, "affiliation"),
     }
+    CACHE_ALIAS = getattr(settings, "SHIBAUTH_CACHE_ALIAS", None)
+    COMPACT_SESSION = getattr(settings, "SHIBAUTH_COMPACT_SESSION", False)
     CREATE_UNKNOWN_USER = getattr(settings, "SHIBAUTH_CREATE_UNKNOWN_USER", True)
+    DATABASE = getattr(settings, "SHIBAUTH_DATABASE", None)
+    EXEMPT_PATHS = getattr(settings, "SHIBAUTH_EXEMPT_PATHS", [])
+    FORCE_REAUTH_COOKIE = getattr(settings, "SHIBAUTH_FORCE_REAUTH_COOKIE", None)
+    FORCE_REAUTH_COOKIE_AGE = getattr(settings, "SHIBAUTH_FORCE_REAUTH_COOKIE_AGE", 60 * 60)
     GROUP_ATTRIBUTES = getattr(settings, "SHIBAUTH_GROUP_ATTRIBUTES", [])
+    GROUP_CATALOG = getattr(settings, "SHIBAUTH_GROUP_CATALOG", False)
+    GROUP_DELIMITER = getattr(settings, "SHIBAUTH_GROUP_DELIMITER", ";")
+    GROUP_SYNC_INTERVAL = getattr(settings, "SHIBAUTH_GROUP_SYNC_INTERVAL", None)
     LOGIN_URL = getattr(settings, "SHIBAUTH_LOGIN_URL", None)
     LOGOUT_REDIRECT_URL = getattr(settings, "SHIBAUTH_LOGOUT_REDIRECT_URL", "https://shibboleth.main.ad.rit.edu/logout.html")  # noqa; E501
+    LOGOUT_NOTIFY_QUEUE_SIZE = getattr(settings, "SHIBAUTH_LOGOUT_NOTIFY_QUEUE_SIZE", 100)
+    LOGOUT_NOTIFY_RETRIES = getattr(settings, "SHIBAUTH_LOGOUT_NOTIFY_RETRIES", 2)
+    LOGOUT_NOTIFY_TIMEOUT = getattr(settings, "SHIBAUTH_LOGOUT_NOTIFY_TIMEOUT", 5)
+    LOGOUT_NOTIFY_URL = getattr(settings, "SHIBAUTH_LOGOUT_NOTIFY_URL", "https://shibboleth.main.ad.rit.edu/logout.html")  # noqa; E501
+    LOGOUT_NOTIFY_WORKERS = getattr(settings, "SHIBAUTH_LOGOUT_NOTIFY_WORKERS", 2)
     LOGOUT_SESSION_KEY = getattr(settings, "SHIBAUTH_FORCE_REAUTH_SESSION_KEY", "shib_force_reauth")  # noqa; E501
-    MOCK_HEADERS = False
+    MOCK_HEADERS = getattr(settings, "SHIBAUTH_MOCK_HEADERS", None)
+    PERMISSION_SNAPSHOT = getattr(settings, "SHIBAUTH_PERMISSION_SNAPSHOT", False)
+    PROFILE_EXECUTOR = getattr(settings, "SHIBAUTH_PROFILE_EXECUTOR", None)
+    READ_DATABASE = getattr(settings, "SHIBAUTH_READ_DATABASE", None)
+    READ_DATABASE_CHECK_ACTIVE = getattr(settings, "SHIBAUTH_READ_DATABASE_CHECK_ACTIVE", False)
     REDIRECT_FIELD_NAME = getattr(settings, "SHIBAUTH_REDIRECT_FIELD_NAME", "target")
     REMOTE_USER_HEADER = getattr(settings, "SHIBAUTH_REMOTE_USER_HEADER", "REMOTE_USER")
+    SESSION_ATTRIBUTES = getattr(settings, "SHIBAUTH_SESSION_ATTRIBUTES", None)
+    SHARED_USER_CACHE = getattr(settings, "SHIBAUTH_SHARED_USER_CACHE", False)
+    STATELESS_PATHS = getattr(settings, "SHIBAUTH_STATELESS_PATHS", [])
+    TIMING_EXPORTERS = getattr(settings, "SHIBAUTH_TIMING_EXPORTERS", [])
+    UPSERT_USERS = getattr(settings, "SHIBAUTH_UPSERT_USERS", False)
+    USER_CACHE_SIZE = getattr(settings, "SHIBAUTH_USER_CACHE_SIZE", 0)
+    USER_CACHE_TIMEOUT = getattr(settings, "SHIBAUTH_USER_CACHE_TIMEOUT", 300)
 
     class Meta:
         prefix = "SHIBAUTH"
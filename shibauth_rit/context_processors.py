@@ -1,13 +1,36 @@
 # -*- coding: utf-8 -*-
 
 # Third Party Library Imports
+from django.utils.functional import SimpleLazyObject
 from django.utils.six.moves.urllib_parse import quote
 
 # First Party Library Imports
 from shibauth_rit.conf import settings
 
 # Local Imports
-from .compat import reverse
+from .compat import get_script_prefix, get_urlconf, reverse
+
+_reversed_urls = {}
+
+
+def reverse_once(viewname):
+    """
+    ``reverse()`` a URL without arguments, memoized per URLconf and script
+    prefix, as both are all that can change its result.
+    """
+    key = (viewname, get_urlconf(), get_script_prefix())
+    url = _reversed_urls.get(key)
+    if url is None:
+        url = _reversed_urls[key] = reverse(viewname)
+    return url
+
+
+def reset_reversed_urls(**kwargs):
+    """
+    ``setting_changed`` receiver throwing away the memoized URLs.
+    """
+    if kwargs.get('setting') in (None, 'ROOT_URLCONF', 'FORCE_SCRIPT_NAME'):
+        _reversed_urls.clear()
 
 
 def login_link(request):
@@ -15,10 +38,11 @@ def login_link(request):
     This assumes your login link is the Shibboleth login page for your server
     and uses the 'target' url parameter.
     """
-    full_path = quote(request.get_full_path())
-    login = reverse('shibauth_rit:shibauth_login')
-    login_link = "%s?target=%s" % (login, full_path)
-    return {'login_link': login_link}
+    def login_link():
+        full_path = quote(request.get_full_path())
+        login = reverse_once('shibauth_rit:shibauth_login')
+        return "%s?target=%s" % (login, full_path)
+    return {'login_link': SimpleLazyObject(login_link)}
 
 
 def logout_link(request, *args):
@@ -27,10 +51,11 @@ def logout_link(request, *args):
     and uses the 'target' url parameter.
     e.g: https://school.edu/Shibboleth.sso/Login
     """
-    LOGOUT_REDIRECT_URL = getattr(settings, "SHIBAUTH_LOGOUT_REDIRECT_URL")
-    # LOGOUT_REDIRECT_URL specifies a default logout page that will always be used when
-    # users logout from Shibboleth.
-    target = LOGOUT_REDIRECT_URL or quote(request.build_absolute_uri())
-    logout = reverse('shibauth_rit:shibauth_logout')
-    logout_link = "%s?target=%s" % (logout, target)
-    return {'logout_link': logout_link}
+    def logout_link():
+        LOGOUT_REDIRECT_URL = getattr(settings, "SHIBAUTH_LOGOUT_REDIRECT_URL")
+        # LOGOUT_REDIRECT_URL specifies a default logout page that will always be used when
+        # users logout from Shibboleth.
+        target = LOGOUT_REDIRECT_URL or quote(request.build_absolute_uri())
+        logout = reverse_once('shibauth_rit:shibauth_logout')
+        return "%s?target=%s" % (logout, target)
+    return {'logout_link': SimpleLazyObject(logout_link)}
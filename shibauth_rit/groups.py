@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import threading
+import time
+from contextlib import contextmanager
+
+# Third Party Library Imports
+from django.contrib.auth.models import Group
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, router, transaction
+from django.db.models.signals import m2m_changed
+
+# First Party Library Imports
+from shibauth_rit.conf import settings
+from shibauth_rit.utils import is_shared_cache
+
+# Local Imports
+from .compat import bulk_create_ignores_conflicts, on_commit
+
+_group_catalog = None
+_group_catalog_lock = threading.Lock()
+
+
+def _groups_cache():
+    return caches[getattr(settings, "SHIBAUTH_CACHE_ALIAS") or 'default']
+
+
+def bulk_create_ignoring_conflicts(model, objs):
+    """
+    Insert ``objs`` in a single statement, skipping rows that already exist.
+    Older versions of Django can't ignore conflicts so if another thread won
+    the race we fall back to inserting the rows one at a time, and only skip
+    those that turn out to exist.  Other integrity errors are raised.
+    """
+    if not objs:
+        return
+    if bulk_create_ignores_conflicts:
+        model._default_manager.bulk_create(objs, ignore_conflicts=True)
+        return
+    try:
+        with transaction.atomic():
+            model._default_manager.bulk_create(objs)
+    except IntegrityError:
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    obj.save(force_insert=True)
+            except IntegrityError:
+                if not _exists(obj):
+                    raise
+
+
+def _exists(obj):
+    """
+    Whether a row with the same unique values as ``obj`` exists.
+    """
+    opts = obj._meta
+    unique_fields = [[field.attname] for field in opts.local_concrete_fields if field.unique]
+    unique_fields += [[opts.get_field(name).attname for name in names] for names in opts.unique_together]
+    for attnames in unique_fields:
+        values = dict((attname, getattr(obj, attname)) for attname in attnames)
+        if None not in values.values() and type(obj)._default_manager.filter(**values).exists():
+            return True
+    return False
+
+
+def get_or_create_group_ids(names):
+    """
+    Return a ``{name: pk}`` dict for the given group names, creating any groups
+    that don't exist yet with one bulk insert.
+    """
+    names = set(names)
+    if not names:
+        return {}
+    group_ids = dict(Group.objects.filter(name__in=names).values_list('name', 'pk'))
+    missing = names.difference(group_ids)
+    if missing:
+        bulk_create_ignoring_conflicts(Group, [Group(name=name) for name in missing])
+        # Not every database returns primary keys from a bulk insert.
+        group_ids.update(Group.objects.filter(name__in=missing).values_list('name', 'pk'))
+    return group_ids
+
+
+class GroupCatalog(object):
+    """
+    A map of group names to primary keys, loaded with one query the first time
+    it's needed, so looking up known groups costs no queries at all.
+
+    The map is kept in the process, or in a Django cache when one is given so
+    every process shares it.  Saving or deleting a ``Group`` drops it from the
+    map, it's looked up again the next time it's needed.  A map kept in the
+    process is reloaded when another process bumps the generation stored in the
+    ``SHIBAUTH_CACHE_ALIAS`` cache, or ``default``, after changing a group.
+    Created groups are only added to the map once they are committed.
+    """
+    cache_key = 'shibauth_rit:groups'
+    generation_key = 'shibauth_rit:groups:generation'
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._ids = None
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def get_ids(self, names):
+        """
+        Return a ``{name: pk}`` dict for the given group names, creating any
+        groups that don't exist yet.
+        """
+        names = set(names)
+        ids = self._catalog()
+        group_ids = dict((name, ids[name]) for name in names if name in ids)
+        missing = names.difference(group_ids)
+        if missing:
+            created = get_or_create_group_ids(missing)
+            group_ids.update(created)
+            on_commit(lambda: self._add(created), using=router.db_for_write(Group))
+        return group_ids
+
+    def discard(self, pk):
+        if self.cache is not None:
+            self.cache.delete(self.cache_key)
+            return
+        # Make the other processes reload their map.
+        generations = _groups_cache()
+        try:
+            generations.incr(self.generation_key)
+        except ValueError:
+            generations.add(self.generation_key, 1, None)
+        with self._lock:
+            if self._ids is not None:
+                # Replace the map instead of changing it, readers don't lock.
+                self._ids = dict((name, group_pk) for name, group_pk in self._ids.items() if group_pk != pk)
+
+    def clear(self):
+        if self.cache is not None:
+            self.cache.delete(self.cache_key)
+        with self._lock:
+            self._ids = None
+
+    def _catalog(self):
+        if self.cache is not None:
+            ids = self.cache.get(self.cache_key)
+            if ids is None:
+                ids = self._load()
+                self.cache.set(self.cache_key, ids, None)
+            return ids
+        generation = _groups_cache().get(self.generation_key)
+        ids = self._ids
+        if ids is None or self._generation != generation:
+            with self._lock:
+                if self._ids is None or self._generation != generation:
+                    self._ids = self._load()
+                    self._generation = generation
+                ids = self._ids
+        return ids
+
+    def _add(self, group_ids):
+        if self.cache is not None:
+            # Losing a concurrent update only costs the other process a lookup.
+            ids = self.cache.get(self.cache_key)
+            if ids is not None:
+                ids.update(group_ids)
+                self.cache.set(self.cache_key, ids, None)
+            return
+        with self._lock:
+            if self._ids is not None:
+                ids = dict(self._ids)
+                ids.update(group_ids)
+                self._ids = ids
+
+    @staticmethod
+    def _load():
+        return dict(Group.objects.values_list('name', 'pk'))
+
+
+def group_catalog_enabled():
+    """
+    Whether ``SHIBAUTH_GROUP_CATALOG`` is set and changed groups reach every
+    process through a shared cache.  With a per-process cache, a group deleted
+    in one process would stay in the maps of the others.
+    """
+    if not getattr(settings, "SHIBAUTH_GROUP_CATALOG"):
+        return False
+    return is_shared_cache(_groups_cache())
+
+
+def check_group_catalog():
+    """
+    Refuse to start with ``SHIBAUTH_GROUP_CATALOG`` and a per-process cache.
+    """
+    if getattr(settings, "SHIBAUTH_GROUP_CATALOG") and not group_catalog_enabled():
+        raise ImproperlyConfigured(
+            ('`SHIBAUTH_GROUP_CATALOG` needs a cache shared by every process, set `SHIBAUTH_CACHE_ALIAS`'
+             ' or the `default` cache to a memcached, redis or database cache.'))
+
+
+def get_group_catalog():
+    """
+    Return the ``GroupCatalog`` if ``SHIBAUTH_GROUP_CATALOG`` is enabled, shared
+    through the ``SHIBAUTH_CACHE_ALIAS`` cache if that is set.
+    """
+    global _group_catalog
+    if not group_catalog_enabled():
+        return None
+    if _group_catalog is None:
+        with _group_catalog_lock:
+            if _group_catalog is None:
+                alias = getattr(settings, "SHIBAUTH_CACHE_ALIAS")
+                _group_catalog = GroupCatalog(caches[alias] if alias is not None else None)
+    return _group_catalog
+
+
+def get_group_ids(names):
+    """
+    Return a ``{name: pk}`` dict for the given group names, creating any groups
+    that don't exist yet, through the catalog if it's enabled.
+    """
+    catalog = get_group_catalog()
+    if catalog is None:
+        return get_or_create_group_ids(names)
+    return catalog.get_ids(names)
+
+
+def reset_group_catalog(setting, **kwargs):
+    """
+    ``setting_changed`` receiver throwing away the catalog.
+    """
+    global _group_catalog
+    if setting in ('SHIBAUTH_GROUP_CATALOG', 'SHIBAUTH_CACHE_ALIAS'):
+        _group_catalog = None
+
+
+def discard_cataloged_group(sender, instance, **kwargs):
+    """
+    ``post_save`` and ``post_delete`` receiver removing a changed group from
+    the catalog.
+    """
+    catalog = get_group_catalog()
+    if catalog is not None:
+        catalog.discard(instance.pk)
+
+
+def _group_sync_key(user):
+    return 'shibauth_rit:groups:synced:%s' % user.pk
+
+
+def is_group_sync_due(user):
+    """
+    Whether the groups of ``user`` should be synchronized, that is unless they
+    were less than ``SHIBAUTH_GROUP_SYNC_INTERVAL`` seconds ago.
+    """
+    if not getattr(settings, "SHIBAUTH_GROUP_SYNC_INTERVAL"):
+        return True
+    return _groups_cache().get(_group_sync_key(user)) is None
+
+
+def record_group_sync(user):
+    """
+    Remember when the groups of ``user`` were synchronized for
+    ``SHIBAUTH_GROUP_SYNC_INTERVAL`` seconds.
+    """
+    interval = getattr(settings, "SHIBAUTH_GROUP_SYNC_INTERVAL")
+    if interval:
+        _groups_cache().set(_group_sync_key(user), time.time(), interval)
+
+
+def forget_group_sync(user):
+    if getattr(settings, "SHIBAUTH_GROUP_SYNC_INTERVAL"):
+        _groups_cache().delete(_group_sync_key(user))
+
+
+def sync_user_groups(user, names):
+    """
+    Make ``user`` a member of exactly the groups in ``names``.
+
+    The current memberships are read once and only the difference is written,
+    straight to the many-to-many through table, so the number of queries doesn't
+    grow with the number of groups.  With the group catalog only the through
+    table is queried.  ``m2m_changed`` is sent like ``user.groups.add()`` and
+    ``user.groups.remove()`` send it.
+    """
+    names = set(names)
+    manager = user.groups
+    through = manager.through
+    source = '%s_id' % manager.source_field_name
+    target = '%s_id' % manager.target_field_name
+
+    catalog = get_group_catalog()
+    if catalog is not None:
+        wanted = set(catalog.get_ids(names).values())
+        memberships = through._default_manager.filter(**{source: user.pk})
+        current = set(memberships.values_list(target, flat=True))
+        stale = current.difference(wanted)
+        if stale:
+            with _membership_change(user, 'remove', stale):
+                memberships.filter(**{'%s__in' % target: stale}).delete()
+        added = wanted.difference(current)
+        if added:
+            with _membership_change(user, 'add', added):
+                bulk_create_ignoring_conflicts(through, [through(**{source: user.pk, target: pk}) for pk in added])
+        return
+
+    current = dict(manager.values_list('name', 'pk'))
+    stale = set(pk for name, pk in current.items() if name not in names)
+    if stale:
+        with _membership_change(user, 'remove', stale):
+            through._default_manager.filter(**{source: user.pk, '%s__in' % target: stale}).delete()
+
+    added = names.difference(current)
+    if added:
+        group_ids = get_or_create_group_ids(added)
+        with _membership_change(user, 'add', set(group_ids.values())):
+            bulk_create_ignoring_conflicts(
+                through, [through(**{source: user.pk, target: pk}) for pk in group_ids.values()])
+
+
+@contextmanager
+def _membership_change(user, action, group_pks):
+    """
+    Send ``m2m_changed`` for the user's groups before and after the block adds
+    or removes the memberships of the groups with the primary keys ``group_pks``.
+    """
+    manager = user.groups
+    kwargs = dict(
+        sender=manager.through, instance=user, reverse=False, model=manager.model, pk_set=group_pks,
+        using=router.db_for_write(manager.through, instance=user))
+    m2m_changed.send(action='pre_%s' % action, **kwargs)
+    yield
+    m2m_changed.send(action='post_%s' % action, **kwargs)
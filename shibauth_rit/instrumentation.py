@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import logging
+import socket
+from collections import deque
+from contextlib import contextmanager
+
+# Third Party Library Imports
+from django.db import connections
+from django.utils import six
+from django.utils.module_loading import import_string
+
+# First Party Library Imports
+from shibauth_rit.conf import settings
+from shibauth_rit.signals import login_phase_finished
+
+# Local Imports
+from .compat import ExitStack, has_execute_wrapper, monotonic
+
+_exporters = []
+
+
+@contextmanager
+def timed_phase(request, phase):
+    """
+    Time the block, count its queries if an exporter wants them, then send
+    ``login_phase_finished``.  Does nothing unless something is connected to
+    the signal.
+    """
+    if not login_phase_finished.has_listeners():
+        yield
+        return
+    if any(exporter.counts_queries for exporter in _exporters):
+        counter = count_queries()
+    else:
+        counter = no_queries()
+    start = monotonic()
+    try:
+        with counter as queries:
+            yield
+    finally:
+        duration = monotonic() - start
+        login_phase_finished.send(
+            sender=request.__class__, request=request, phase=phase, duration=duration, queries=queries[0])
+
+
+@contextmanager
+def no_queries():
+    yield [None]
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the queries run on every database, yielding a list holding the count
+    once the block is done.  Instrumenting a connection doesn't open it, and
+    one opened inside the block, e.g. by the first query of the request, is
+    counted as well.
+    """
+    count = [0]
+    databases = connections.all()
+    if has_execute_wrapper:
+        def counter(execute, sql, params, many, context):
+            count[0] += 1
+            return execute(sql, params, many, context)
+
+        with ExitStack() as stack:
+            for db in databases:
+                stack.enter_context(db.execute_wrapper(counter))
+            yield count
+        return
+    # Older versions of Django can only log the queries.  They're logged to a
+    # fresh log, which unlike the one of the connection can't be full yet.
+    saved = [(db.force_debug_cursor, db.queries_log) for db in databases]
+    for db in databases:
+        db.force_debug_cursor = True
+        db.queries_log = deque(maxlen=db.queries_limit)
+    try:
+        yield count
+    finally:
+        for db, (debug_cursor, queries_log) in zip(databases, saved):
+            count[0] += len(db.queries_log)
+            if debug_cursor or settings.DEBUG:
+                queries_log.extend(db.queries_log)
+            db.force_debug_cursor = debug_cursor
+            db.queries_log = queries_log
+
+
+class BaseExporter(object):
+    """
+    Receives the timings of the login phases.  Subclasses implement ``export``
+    and are enabled by listing them in ``SHIBAUTH_TIMING_EXPORTERS``.
+
+    Queries are only counted while an exporter sets ``counts_queries``,
+    otherwise ``queries`` is None.
+    """
+    counts_queries = True
+
+    def export(self, phase, duration, queries):
+        """
+        ``duration`` is in seconds, ``queries`` is the number of queries run.
+        """
+        raise NotImplementedError
+
+    def receive(self, sender, phase, duration, queries, **kwargs):
+        self.export(phase, duration, queries)
+
+
+class LoggingExporter(BaseExporter):
+    """
+    Log every phase to the ``shibauth_rit.timing`` logger.
+    """
+
+    def __init__(self, logger='shibauth_rit.timing', level=logging.INFO):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def export(self, phase, duration, queries):
+        self.logger.log(self.level, '%s took %.2fms and %d queries', phase, duration * 1000, queries)
+
+
+class StatsdExporter(BaseExporter):
+    """
+    Send every phase as a statsd timer and query counter over UDP.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='shibauth_rit'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def export(self, phase, duration, queries):
+        name = '%s.%s' % (self.prefix, phase)
+        data = '%s:%.3f|ms\n%s.queries:%d|c' % (name, duration * 1000, name, queries)
+        try:
+            self.socket.sendto(data.encode('ascii'), self.address)
+        except (socket.error, socket.gaierror):
+            pass
+
+
+def connect_exporters():
+    """
+    Connect the exporters configured in ``SHIBAUTH_TIMING_EXPORTERS``, either
+    dotted paths or ``(dotted path, keyword arguments)`` pairs, to
+    ``login_phase_finished``.
+    """
+    disconnect_exporters()
+    for exporter in getattr(settings, "SHIBAUTH_TIMING_EXPORTERS"):
+        path, kwargs = (exporter, {}) if isinstance(exporter, six.string_types) else exporter
+        exporter = import_string(path)(**kwargs)
+        login_phase_finished.connect(exporter.receive)
+        _exporters.append(exporter)
+
+
+def disconnect_exporters():
+    while _exporters:
+        login_phase_finished.disconnect(_exporters.pop().receive)
+
+
+def reset_exporters(setting, **kwargs):
+    """
+    ``setting_changed`` receiver reconnecting the exporters.
+    """
+    if setting == 'SHIBAUTH_TIMING_EXPORTERS':
+        connect_exporters()
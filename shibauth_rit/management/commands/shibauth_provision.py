@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import base64
+import csv
+import io
+import sys
+from collections import OrderedDict
+from itertools import islice
+
+# Third Party Library Imports
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import six
+
+# First Party Library Imports
+from shibauth_rit.attributes import get_attribute_plan, get_username_attribute, parse_headers
+from shibauth_rit.backends import ShibauthRitBackend
+from shibauth_rit.cache import invalidate_cached_user
+from shibauth_rit.compat import has_bulk_update
+from shibauth_rit.conf import settings
+from shibauth_rit.groups import bulk_create_ignoring_conflicts, get_group_ids
+from shibauth_rit.models import GroupSyncState
+from shibauth_rit.permissions import bump_user_permissions_version
+from shibauth_rit.utils import fingerprint
+
+
+def _text(value, encoding):
+    return value.decode(encoding) if isinstance(value, bytes) else value
+
+
+def read_csv(stream, encoding='utf-8'):
+    """
+    Yield a dict per row of a CSV file whose header row holds the attribute
+    names.  Multi-valued attributes are separated by ``;`` like in the headers.
+    """
+    for row in csv.DictReader(stream):
+        yield dict((_text(name, encoding), _text(value or '', encoding)) for name, value in row.items() if name)
+
+
+def _unfold(stream, encoding):
+    line = None
+    for physical in stream:
+        physical = _text(physical, encoding).rstrip('\r\n')
+        if line is not None and physical.startswith(' '):
+            line += physical[1:]
+            continue
+        if line is not None:
+            yield line
+        line = physical
+    if line is not None:
+        yield line
+
+
+def read_ldif(stream, encoding='utf-8'):
+    """
+    Yield a dict per entry of an LDIF file.  The values of a multi-valued
+    attribute are joined with ``;`` like the Shibboleth SP does.
+    """
+    entry = OrderedDict()
+    for line in _unfold(stream, encoding):
+        if not line:
+            if 'dn' in entry:
+                yield dict((name, ';'.join(values)) for name, values in entry.items())
+            entry = OrderedDict()
+            continue
+        if line.startswith('#') or line == '-':
+            continue
+        name, separator, value = line.partition(':')
+        if not separator:
+            raise CommandError('Invalid LDIF line: %r' % line)
+        if value.startswith(':'):
+            value = base64.b64decode(value[1:].strip()).decode('utf-8')
+        entry.setdefault(name, []).append(value.strip())
+    if 'dn' in entry:
+        yield dict((name, ';'.join(values)) for name, values in entry.items())
+
+
+def match_usernames(usernames, stored):
+    """
+    Map each of ``usernames`` to the username in ``stored`` it matches, exactly
+    or else ignoring case, as a database with a case-insensitive collation
+    matches them.  Usernames without a match are left out.
+    """
+    folded = dict((name.lower(), name) for name in stored)
+    matched = {}
+    for username in usernames:
+        if username in stored:
+            matched[username] = username
+        elif username.lower() in folded:
+            matched[username] = folded[username.lower()]
+    return matched
+
+
+readers = {
+    'csv': read_csv,
+    'ldif': read_ldif,
+}
+
+
+class Provisioner(object):
+    """
+    Creates or updates the users of a batch of attribute records, and their
+    groups, with a constant number of queries per batch.
+    """
+
+    def __init__(self, username_attribute=None, sync_groups=True, create_users=None):
+        self.username_attribute = username_attribute or get_username_attribute()
+        self.sync_groups = sync_groups and bool(getattr(settings, "SHIBAUTH_GROUP_ATTRIBUTES"))
+        if create_users is None:
+            create_users = getattr(settings, "SHIBAUTH_CREATE_UNKNOWN_USER")
+        self.create_users = create_users
+        self.backend = ShibauthRitBackend()
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.skipped = 0
+
+    def provision(self, records):
+        User = get_user_model()
+        plan = get_attribute_plan()
+        users = OrderedDict()
+        for record in records:
+            username = record.get(self.username_attribute)
+            attributes = parse_headers(record)
+            shib_meta = attributes.meta
+            if not username or attributes.error:
+                self.skipped += 1
+                continue
+            username = self.backend.clean_username(username)
+            fields = dict(
+                (field, shib_meta[field][0])
+                for field in plan.required_fields + plan.optional_fields if field in shib_meta)
+            fields[User.USERNAME_FIELD] = username
+            users[username] = (fields, attributes.groups if self.sync_groups else ())
+        if not users:
+            return
+        with transaction.atomic():
+            self.provision_users(User, users)
+            if self.sync_groups:
+                self.provision_groups(User, users)
+
+    def provision_users(self, User, users):
+        lookup = '%s__in' % User.USERNAME_FIELD
+        existing = dict((user.get_username(), user) for user in User._default_manager.filter(**{lookup: list(users)}))
+        matched = match_usernames(users, existing)
+        new_users = []
+        changed = []
+        for username, (fields, _) in users.items():
+            if username in matched:
+                user = existing[matched[username]]
+            elif not self.create_users:
+                self.skipped += 1
+                continue
+            else:
+                user = User(**fields)
+                # See ShibauthRitBackend.authenticate.
+                user.set_unusable_password()
+                user.is_active = True
+                new_users.append(user)
+                continue
+            # The username may only match ignoring case, keep the stored one.
+            changes = dict(
+                (field, value) for field, value in fields.items()
+                if field != User.USERNAME_FIELD and getattr(user, field) != value)
+            if changes:
+                for field, value in changes.items():
+                    setattr(user, field, value)
+                changed.append((user, changes))
+            else:
+                self.unchanged += 1
+        bulk_create_ignoring_conflicts(User, new_users)
+        if new_users:
+            # Inserting in bulk doesn't set the primary keys everywhere, fetch the
+            # created users to call the hook ShibauthRitBackend.authenticate calls.
+            created = [user.get_username() for user in new_users]
+            for user in User._default_manager.filter(**{lookup: created}):
+                self.backend.configure_user(user)
+        if changed and has_bulk_update:
+            fields = set()
+            for _, changes in changed:
+                fields.update(changes)
+            User._default_manager.bulk_update([user for user, _ in changed], sorted(fields))
+        else:
+            for user, changes in changed:
+                User._default_manager.filter(pk=user.pk).update(**changes)
+        # Neither writes sends post_save, so drop the cached users by hand.
+        for user, _ in changed:
+            invalidate_cached_user(sender=User, instance=user)
+        self.created += len(new_users)
+        self.updated += len(changed)
+
+    def provision_groups(self, User, users):
+        lookup = '%s__in' % User.USERNAME_FIELD
+        user_ids = dict(User._default_manager.filter(**{lookup: list(users)}).values_list(User.USERNAME_FIELD, 'pk'))
+        matched = match_usernames(users, user_ids)
+        # Users that weren't created have no groups to synchronize.
+        groups = dict(
+            (user_ids[matched[username]], set(names)) for username, (_, names) in users.items() if username in matched)
+        if not groups:
+            return
+        fingerprints = dict((pk, fingerprint(names)) for pk, names in groups.items())
+        synced = dict(GroupSyncState.objects.filter(user__in=list(groups)).values_list('user', 'fingerprint'))
+        stale_users = [pk for pk in groups if synced.get(pk) != fingerprints[pk]]
+        if not stale_users:
+            return
+
+        field = User._meta.get_field('groups')
+        through = User.groups.through
+        source = '%s_id' % field.m2m_field_name()
+        target = '%s_id' % field.m2m_reverse_field_name()
+        group_ids = get_group_ids(set().union(*(groups[pk] for pk in stale_users)))
+        wanted = set((pk, group_ids[name]) for pk in stale_users for name in groups[pk])
+        current = through._default_manager.filter(**{'%s__in' % source: stale_users}).values_list('pk', source, target)
+        current_rows = set()
+        stale_rows = []
+        changed_users = set()
+        for row_pk, user_pk, group_pk in current:
+            if (user_pk, group_pk) in wanted:
+                current_rows.add((user_pk, group_pk))
+            else:
+                stale_rows.append(row_pk)
+                changed_users.add(user_pk)
+        if stale_rows:
+            through._default_manager.filter(pk__in=stale_rows).delete()
+        added_rows = wanted - current_rows
+        bulk_create_ignoring_conflicts(
+            through, [through(**{source: user_pk, target: group_pk}) for user_pk, group_pk in added_rows])
+        # The through table is written directly, so m2m_changed isn't sent.
+        changed_users.update(user_pk for user_pk, _ in added_rows)
+        bump_user_permissions_version(changed_users)
+
+        GroupSyncState.objects.filter(user__in=stale_users).delete()
+        bulk_create_ignoring_conflicts(
+            GroupSyncState, [GroupSyncState(user_id=pk, fingerprint=fingerprints[pk]) for pk in stale_users])
+
+
+class Command(BaseCommand):
+    help = ("Create or update users, groups and group memberships from a CSV or LDIF export "
+            "of Shibboleth attributes, so their first login doesn't have to.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="the CSV or LDIF file, or '-' to read standard input")
+        parser.add_argument(
+            '--format', choices=sorted(readers), help='the format of the file, by default guessed from its name')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000, help='number of records written at once (default: 1000)')
+        parser.add_argument(
+            '--username-attribute',
+            help='the attribute holding the username, by default the one mapped to the username field')
+        parser.add_argument(
+            '--encoding', default='utf-8', help='the encoding of the file or standard input (default: utf-8)')
+        parser.add_argument(
+            '--create', action='store_true',
+            help='create unknown users even if SHIBAUTH_CREATE_UNKNOWN_USER is False')
+        parser.add_argument(
+            '--no-groups', action='store_false', dest='groups', help="don't synchronize the group memberships")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('ldif' if path.lower().endswith('.ldif') else 'csv')
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        if path == '-' and six.PY2:
+            stream = sys.stdin
+        elif path == '-':
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding=options['encoding'], newline='')
+        elif six.PY2:
+            # The Python 2 csv module only reads bytes, the values are decoded by the readers.
+            stream = io.open(path, 'rb')
+        else:
+            stream = io.open(path, encoding=options['encoding'], newline='')
+
+        provisioner = Provisioner(
+            options['username_attribute'], sync_groups=options['groups'], create_users=options['create'] or None)
+        try:
+            records = readers[file_format](stream, options['encoding'])
+            while True:
+                batch = list(islice(records, batch_size))
+                if not batch:
+                    break
+                provisioner.provision(batch)
+                if options['verbosity'] > 1:
+                    self.stdout.write('Provisioned %d users.' % (
+                        provisioner.created + provisioner.updated + provisioner.unchanged))
+        finally:
+            if path != '-':
+                stream.close()
+            elif not six.PY2:
+                # Leave standard input open.
+                stream.detach()
+
+        self.stdout.write('%d created, %d updated, %d unchanged, %d skipped.' % (
+            provisioner.created, provisioner.updated, provisioner.unchanged, provisioner.skipped))
@@ -1,14 +1,37 @@
 # -*- coding: utf-8 -*-
 
+# Standard Library Imports
+import io
+import json
+import logging
+from contextlib import contextmanager
+from itertools import count
+
 # Third Party Library Imports
 import django
 from django.contrib import auth
+from django.contrib.auth import get_user_model
 from django.contrib.auth.middleware import RemoteUserMiddleware
-from django.contrib.auth.models import Group
-from django.core.exceptions import ImproperlyConfigured
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db import IntegrityError, router, transaction
+from django.utils import six
 
 # First Party Library Imports
+from shibauth_rit.attributes import get_username_attribute, parse_request
+from shibauth_rit.cache import invalidate_cached_user
+from shibauth_rit.compat import MiddlewareMixin, on_commit
 from shibauth_rit.conf import settings
+from shibauth_rit.groups import (forget_group_sync, get_group_catalog, is_group_sync_due,
+                                 record_group_sync, sync_user_groups)
+from shibauth_rit.instrumentation import timed_phase
+from shibauth_rit.models import GroupSyncState
+from shibauth_rit.paths import path_matches
+from shibauth_rit.permissions import attach_permission_snapshot, permission_snapshot_enabled
+from shibauth_rit.profiles import get_profile_executor
+from shibauth_rit.utils import fingerprint, is_reauth_forced
+
+logger = logging.getLogger(__name__)
 
 
 class ShibauthRitMiddleware(RemoteUserMiddleware):
@@ -32,14 +55,19 @@ class ShibauthRitMiddleware(RemoteUserMiddleware):
                  " 'django.contrib.auth.middleware.AuthenticationMiddleware'"
                  " before the RemoteUserMiddleware class.").format(middleware))
 
-        # To support logout.  If this variable is True, do not
+        # Exempt paths never need a user, so don't even load the session.
+        if self.is_exempt(request):
+            return
+
+        # Stateless paths get their user from the headers alone, without a session.
+        if self.is_stateless(request):
+            self.authenticate_stateless(request)
+            return
+
+        # To support logout.  If reauthentication is forced, do not
         # authenticate user and return now.
-        LOGOUT_SESSION_KEY = getattr(settings, "SHIBAUTH_LOGOUT_SESSION_KEY")
-        if request.session.get(LOGOUT_SESSION_KEY):
+        if is_reauth_forced(request):
             return
-        else:
-            # Delete the shib reauth session key if present.
-            request.session.pop(LOGOUT_SESSION_KEY, None)
 
         # Locate the remote user header.
         try:
@@ -62,6 +90,8 @@ class ShibauthRitMiddleware(RemoteUserMiddleware):
         # persisted in the session and we don't need to continue.
         if request.user.is_authenticated():
             if request.user.get_username() == self.clean_username(username, request):
+                if permission_snapshot_enabled():
+                    attach_permission_snapshot(request, request.user)
                 return
             else:
                 # An authenticated user is associated with the request, but
@@ -69,10 +99,11 @@ class ShibauthRitMiddleware(RemoteUserMiddleware):
                 self._remove_invalid_user(request)
 
         # Make sure we have all required Shibboleth elements before proceeding.
-        shib_meta, error = self.parse_attributes(request)
+        with timed_phase(request, 'parse_attributes'):
+            shib_meta, error = self.parse_attributes(request)
 
         # Add parsed attributes to the session.
-        request.session['shib'] = shib_meta
+        self.store_session_attributes(request, shib_meta)
         if error:
             self.handle_parse_exception(shib_meta)
             return
@@ -80,26 +111,119 @@ class ShibauthRitMiddleware(RemoteUserMiddleware):
         # We are seeing this user for the first time in this session, attempt
         # to authenticate the user.
 
-        # Django 1.11 added the request object so we need to pass it if we are on or above it
-        if self.django_1_11:
-            user = auth.authenticate(request, remote_user=username, shib_meta=shib_meta)
-        else:
-            user = auth.authenticate(remote_user=username, shib_meta=shib_meta)
+        # With SHIBAUTH_ATOMIC_LOGIN, everything the login writes is committed at once.
+        with self.login_transaction(request):
+            # Django 1.11 added the request object so we need to pass it if we are on or above it
+            with timed_phase(request, 'authenticate'):
+                if self.django_1_11:
+                    user = auth.authenticate(request, remote_user=username, shib_meta=shib_meta)
+                else:
+                    user = auth.authenticate(remote_user=username, shib_meta=shib_meta)
+
+            if user:
+                # User is valid.  Set request.user and persist user in the session
+                # by logging the user in.
+                request.user = user
+                with timed_phase(request, 'login'):
+                    auth.login(request, user)
+
+                # Upgrade user groups if configured in the settings.py
+                # If activated, the user will be associated with those groups.
+                # SHIBAUTH_GROUP_SYNC_INTERVAL skips users synchronized recently.
+                if getattr(settings, "SHIBAUTH_GROUP_ATTRIBUTES") and (
+                        self.force_group_sync(request, user) or is_group_sync_due(user)):
+                    with timed_phase(request, 'update_user_groups'):
+                        self.update_user_groups(request, user)
+                    record_group_sync(user)
+                # call make profile.
+                with timed_phase(request, 'make_profile'):
+                    executor = get_profile_executor()
+                    if executor is None:
+                        self.make_profile(user, shib_meta)
+                    else:
+                        self.defer_make_profile(executor, user, shib_meta)
 
         if user:
-            # User is valid.  Set request.user and persist user in the session
-            # by logging the user in.
-            request.user = user
-            auth.login(request, user)
-
-            # Upgrade user groups if configured in the settings.py
-            # If activated, the user will be associated with those groups.
-            if getattr(settings, "SHIBAUTH_GROUP_ATTRIBUTES"):
-                self.update_user_groups(request, user)
-            # call make profile.
-            self.make_profile(user, shib_meta)
             # setup session.
             self.setup_session(request)
+            if permission_snapshot_enabled():
+                attach_permission_snapshot(request, user, refresh=True)
+
+    def is_stateless(self, request):
+        """
+        Whether the request path matches ``SHIBAUTH_STATELESS_PATHS``.
+        """
+        return path_matches("SHIBAUTH_STATELESS_PATHS", request.path_info)
+
+    def authenticate_stateless(self, request):
+        """
+        Set ``request.user`` from the Shibboleth headers of every request without
+        touching the session: the user isn't logged in, so neither is
+        ``last_login`` updated, and ``make_profile`` and ``setup_session`` aren't
+        called.  Groups are synchronized when their fingerprint changes, checked
+        on every request or once per ``SHIBAUTH_GROUP_SYNC_INTERVAL``, and the
+        forced reauthentication after a logout only happens with
+        ``SHIBAUTH_FORCE_REAUTH_COOKIE``.
+        """
+        request.user = AnonymousUser()
+        username = request.META.get(self.header)
+        if not username:
+            return
+        if getattr(settings, "SHIBAUTH_FORCE_REAUTH_COOKIE") and is_reauth_forced(request):
+            return
+        shib_meta, error = self.parse_attributes(request)
+        if error:
+            self.handle_parse_exception(shib_meta)
+            return
+        with timed_phase(request, 'authenticate'):
+            if self.django_1_11:
+                user = auth.authenticate(request, remote_user=username, shib_meta=shib_meta)
+            else:
+                user = auth.authenticate(remote_user=username, shib_meta=shib_meta)
+        if not user:
+            return
+        request.user = user
+        if not getattr(settings, "SHIBAUTH_GROUP_ATTRIBUTES"):
+            return
+        # Without an interval, update_user_groups costs a query comparing the fingerprint.
+        if getattr(settings, "SHIBAUTH_GROUP_SYNC_INTERVAL") and not (
+                self.force_group_sync(request, user) or is_group_sync_due(user)):
+            return
+        with timed_phase(request, 'update_user_groups'):
+            self.update_user_groups(request, user)
+        record_group_sync(user)
+
+    @contextmanager
+    def login_transaction(self, request):
+        """
+        Run the login in one transaction on ``get_login_database()`` when
+        ``SHIBAUTH_ATOMIC_LOGIN`` is set.  If the login fails, nothing it wrote is
+        kept, not even in the session.
+        """
+        if not getattr(settings, "SHIBAUTH_ATOMIC_LOGIN"):
+            yield
+            return
+        try:
+            with transaction.atomic(using=self.get_login_database()):
+                yield
+        except Exception:
+            # The user and the groups created by the login may have been cached, and the
+            # group synchronization recorded.
+            if getattr(request.user, 'pk', None) is not None:
+                invalidate_cached_user(sender=type(request.user), instance=request.user)
+                forget_group_sync(request.user)
+            catalog = get_group_catalog()
+            if catalog is not None:
+                catalog.clear()
+            request.session.flush()
+            request.user = AnonymousUser()
+            raise
+
+    def is_exempt(self, request):
+        """
+        Whether the request path matches ``SHIBAUTH_EXEMPT_PATHS``.
+        """
+        return path_matches("SHIBAUTH_EXEMPT_PATHS", request.path_info)
 
     def make_profile(self, user, shib_meta):
         """
@@ -109,6 +233,31 @@ class ShibauthRitMiddleware(RemoteUserMiddleware):
         """
         pass
 
+    def defer_make_profile(self, executor, user, shib_meta):
+        """
+        Hand ``make_profile`` to ``executor`` once the login is committed, with
+        the path of this middleware, the user's primary key and a copy of
+        ``shib_meta`` whose ``(value, required)`` pairs are lists.
+        """
+        middleware_path = '%s.%s' % (type(self).__module__, type(self).__name__)
+        shib_meta = dict((name, list(item)) for name, item in shib_meta.items())
+        on_commit(lambda: executor.submit(middleware_path, user.pk, shib_meta), using=self.get_login_database())
+
+    def get_login_database(self):
+        """
+        The alias of the database the login writes to: ``SHIBAUTH_DATABASE``, or
+        the one users are written to.
+        """
+        return getattr(settings, "SHIBAUTH_DATABASE") or router.db_for_write(get_user_model())
+
+    def force_group_sync(self, request, user):
+        """
+        Whether to synchronize the groups of ``user`` even though that was done
+        less than ``SHIBAUTH_GROUP_SYNC_INTERVAL`` seconds ago.  Extend this to
+        keep the groups of some users, e.g. staff, always up to date.
+        """
+        return False
+
     def setup_session(self, request):
         """
         If you want to add custom code to setup user sessions, you can extend this.
@@ -123,16 +272,54 @@ class ShibauthRitMiddleware(RemoteUserMiddleware):
         """
         pass
 
+    def store_session_attributes(self, request, shib_meta):
+        """
+        Store the parsed attributes in ``request.session['shib']``.
+
+        ``SHIBAUTH_SESSION_ATTRIBUTES`` limits the stored attributes to the listed
+        names and with ``SHIBAUTH_COMPACT_SESSION`` only the values are stored,
+        without the required flags.
+        """
+        allowed = getattr(settings, "SHIBAUTH_SESSION_ATTRIBUTES")
+        compact = getattr(settings, "SHIBAUTH_COMPACT_SESSION")
+        request.session['shib'] = {
+            name: value if compact else (value, required)
+            for name, (value, required) in shib_meta.items()
+            if allowed is None or name in allowed
+        }
+
     def update_user_groups(self, request, user):
+        """
+        Make the user a member of exactly the groups listed in the Shibboleth
+        metadata, creating any groups that don't exist yet.
+
+        The fingerprint of the group attributes is stored per user and nothing is
+        synchronized if it matches the one of the last synchronization.  With
+        ``SHIBAUTH_READ_DATABASE`` the fingerprint is read from the replica first
+        and only read again from the primary if it differs.
+        """
         groups = self.parse_group_attributes(request)
-        # Remove the user from all groups that are not specified in the shibboleth metadata
-        for group in user.groups.all():
-            if group.name not in groups:
-                group.user_set.remove(user)
-        # Add the user to all groups in the shibboleth metadata
-        for g in groups:
-            group, created = Group.objects.get_or_create(name=g)
-            group.user_set.add(user)
+        groups_fingerprint = fingerprint(groups)
+        read_alias = getattr(settings, "SHIBAUTH_READ_DATABASE")
+        if read_alias:
+            # Only go to the primary when the replica doesn't know the groups are synchronized.
+            synced = GroupSyncState.objects.using(read_alias).filter(user=user, fingerprint=groups_fingerprint)
+            if synced.exists():
+                return
+        state = GroupSyncState.objects.filter(user=user)
+        last_fingerprint = state.values_list('fingerprint', flat=True).first()
+        if last_fingerprint == groups_fingerprint:
+            return
+        sync_user_groups(user, groups)
+        if last_fingerprint is None:
+            try:
+                with transaction.atomic():
+                    GroupSyncState.objects.create(user=user, fingerprint=groups_fingerprint)
+            except IntegrityError:
+                # A concurrent login synchronized the same user.
+                state.update(fingerprint=groups_fingerprint)
+        else:
+            state.update(fingerprint=groups_fingerprint)
 
     @staticmethod
     def parse_attributes(request):
@@ -140,31 +327,98 @@ class ShibauthRitMiddleware(RemoteUserMiddleware):
         Parse the incoming Shibboleth attributes and convert them to the internal data structure.
         From: https://github.com/russell/django-shibboleth/blob/master/django_shibboleth/utils.py
         Pull the mapped attributes from the apache headers.
+        Returns a copy of the parsed attributes, which are parsed once per request.
         """
-        shib_attrs = {}
-        error = False
-        meta = request.META
-        attr_map = getattr(settings, "SHIBAUTH_ATTRIBUTE_MAP")
-        for header, attr in list(attr_map.items()):
-            required, name = attr
-            value = meta.get(header, None)
-            shib_attrs[name] = (value, required)
-            if not value or value == '':
-                shib_attrs.pop(name, None)
-                if required:
-                    error = True
-        return shib_attrs, error
+        attributes = parse_request(request)
+        return dict(attributes.meta), attributes.error
 
     @staticmethod
     def parse_group_attributes(request):
         """
-        Parse the Shibboleth attributes for the GROUP_ATTRIBUTES and generate a list of them.
+        Parse the Shibboleth attributes for the GROUP_ATTRIBUTES and generate a list of them,
+        sorted and without duplicates.
         """
-        groups = []
-        group_attrs = getattr(settings, "SHIBAUTH_GROUP_ATTRIBUTES")
-        for attr in group_attrs:
-            groups += filter(bool, request.META.get(attr, '').split(';'))
-        return groups
+        return sorted(parse_request(request).groups)
+
+
+class ShibauthRitMockHeadersMiddleware(MiddlewareMixin):
+    """
+    Development middleware injecting the Shibboleth headers of
+    ``SHIBAUTH_MOCK_HEADERS`` into every request, so the login can be exercised,
+    and load tested, without a Shibboleth service provider.  Put it before
+    ``ShibauthRitMiddleware``.  It refuses to run unless ``DEBUG`` is on.
+
+    ``SHIBAUTH_MOCK_HEADERS`` is one of:
+
+    * a dict of headers, to always log in as the same user,
+    * a list of dicts, used in turn,
+    * the path of a JSON file holding either of these,
+    * a number of synthetic users, used in turn.
+
+    Requests can pick a user with an ``X-Shibauth-Mock-User`` header holding
+    its index, e.g. to keep every client of a load test logged in as one user.
+    """
+    user_header = 'HTTP_X_SHIBAUTH_MOCK_USER'
+
+    def __init__(self, get_response=None):
+        mock_headers = getattr(settings, "SHIBAUTH_MOCK_HEADERS")
+        if not mock_headers:
+            raise MiddlewareNotUsed('SHIBAUTH_MOCK_HEADERS is not set.')
+        if not settings.DEBUG:
+            logger.warning('ShibauthRitMockHeadersMiddleware is disabled because DEBUG is off.')
+            raise MiddlewareNotUsed('DEBUG is off.')
+        self.profiles = self.load_profiles(mock_headers)
+        self.counter = count()
+        super(ShibauthRitMockHeadersMiddleware, self).__init__(get_response)
+
+    def process_request(self, request):
+        index = request.META.get(self.user_header)
+        if index is None or not index.isdigit():
+            index = next(self.counter)
+        request.META.update(self.profiles[int(index) % len(self.profiles)])
+
+    @classmethod
+    def load_profiles(cls, mock_headers):
+        """
+        Turn ``SHIBAUTH_MOCK_HEADERS`` into a list of header dicts that all hold
+        the ``SHIBAUTH_REMOTE_USER_HEADER``.
+        """
+        if isinstance(mock_headers, six.string_types):
+            with io.open(mock_headers, encoding='utf-8') as f:
+                mock_headers = json.load(f)
+        if isinstance(mock_headers, dict):
+            profiles = [mock_headers]
+        elif isinstance(mock_headers, six.integer_types):
+            profiles = cls.synthetic_profiles(mock_headers)
+        else:
+            profiles = list(mock_headers)
+        if not profiles:
+            raise ImproperlyConfigured('SHIBAUTH_MOCK_HEADERS holds no headers.')
+        username_attribute = get_username_attribute()
+        header = getattr(settings, "SHIBAUTH_REMOTE_USER_HEADER")
+        # Like the service provider, set the remote user header as well.
+        return [
+            dict(profile, **{header: profile[username_attribute]})
+            if header not in profile and username_attribute in profile else profile
+            for profile in profiles]
+
+    @staticmethod
+    def synthetic_profiles(number):
+        username_attribute = get_username_attribute()
+        group_attributes = getattr(settings, "SHIBAUTH_GROUP_ATTRIBUTES")
+        profiles = []
+        for i in range(number):
+            username = 'mockuser%d' % i
+            profile = {
+                username_attribute: username,
+                'mail': '%s@example.com' % username,
+                'givenName': 'Mock',
+                'sn': 'User %d' % i,
+            }
+            for attr in group_attributes:
+                profile[attr] = 'mock-everyone;mock-group%d' % (i % 10)
+            profiles.append(profile)
+        return profiles
 
 
 class ShibauthRitValidationError(Exception):
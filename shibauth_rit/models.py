@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+# Third Party Library Imports
+from django.conf import settings
+from django.db import models
+from django.utils.encoding import python_2_unicode_compatible
+
+
+@python_2_unicode_compatible
+class GroupSyncState(models.Model):
+    """
+    Remembers the fingerprint of the Shibboleth group attributes the user's
+    groups were last synchronized from, so the synchronization can be skipped
+    when they haven't changed.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+        related_name='shibauth_group_sync_state')
+    fingerprint = models.CharField(max_length=40)
+
+    def __str__(self):
+        return '%s: %s' % (self.user_id, self.fingerprint)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import logging
+import threading
+
+# Third Party Library Imports
+import requests
+from requests.adapters import HTTPAdapter
+
+# First Party Library Imports
+from shibauth_rit.conf import settings
+from shibauth_rit.workers import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+class LogoutNotifier(object):
+    """
+    Tell the identity provider about logouts from background threads, so the
+    user's redirect doesn't wait for the identity provider to answer.
+    """
+
+    def __init__(self, url, timeout=5, retries=2, workers=2, max_queue_size=100):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = WorkerPool(workers, max_queue_size, name='shibauth-rit-logout')
+
+    def notify(self):
+        """
+        Queue a logout notification.  Returns False if the queue is full.
+        """
+        return self.pool.submit(self.post)
+
+    def post(self):
+        """
+        POST to the logout url, retrying on connection errors, timeouts and
+        server errors.  Other failures, like client errors, aren't retried.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.url, data='', timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except requests.RequestException as e:
+                logger.warning('Logout notification to %s failed: %s', self.url, e)
+                return
+            else:
+                if response.status_code < 500:
+                    if response.status_code >= 400:
+                        logger.warning(
+                            'Logout notification to %s failed: HTTP %d', self.url, response.status_code)
+                    return response
+                error = 'HTTP %d' % response.status_code
+        logger.warning('Logout notification to %s failed: %s', self.url, error)
+
+    def close(self):
+        self.pool.shutdown()
+        self.session.close()
+
+
+def get_logout_notifier():
+    """
+    Return the ``LogoutNotifier`` configured by the ``SHIBAUTH_LOGOUT_NOTIFY_*``
+    settings, or None if ``SHIBAUTH_LOGOUT_NOTIFY_URL`` is not set.
+    """
+    global _notifier
+    url = getattr(settings, "SHIBAUTH_LOGOUT_NOTIFY_URL")
+    if not url:
+        return None
+    if _notifier is None:
+        with _notifier_lock:
+            if _notifier is None:
+                _notifier = LogoutNotifier(
+                    url,
+                    timeout=getattr(settings, "SHIBAUTH_LOGOUT_NOTIFY_TIMEOUT"),
+                    retries=getattr(settings, "SHIBAUTH_LOGOUT_NOTIFY_RETRIES"),
+                    workers=getattr(settings, "SHIBAUTH_LOGOUT_NOTIFY_WORKERS"),
+                    max_queue_size=getattr(settings, "SHIBAUTH_LOGOUT_NOTIFY_QUEUE_SIZE"),
+                )
+    return _notifier
+
+
+def reset_logout_notifier(setting, **kwargs):
+    """
+    ``setting_changed`` receiver closing the notifier so it's rebuilt from the
+    new settings.
+    """
+    global _notifier
+    if setting.startswith('SHIBAUTH_LOGOUT_NOTIFY_'):
+        with _notifier_lock:
+            notifier, _notifier = _notifier, None
+        if notifier is not None:
+            notifier.close()
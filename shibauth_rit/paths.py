@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import re
+
+# First Party Library Imports
+from shibauth_rit.conf import settings
+
+_path_matchers = {}  # setting -> (paths, compiled pattern)
+
+
+def compile_paths(paths):
+    """
+    Compile a list of paths into a single pattern, or None if it's empty.
+    Paths starting with ``^`` are regular expressions, others are prefixes.
+    """
+    patterns = [path if path.startswith('^') else '^%s' % re.escape(path) for path in paths]
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % pattern for pattern in patterns))
+
+
+def get_path_matcher(setting):
+    """
+    Return the compiled pattern of the paths in ``setting``, compiling it only
+    when the setting has changed.
+    """
+    paths = getattr(settings, setting)
+    matcher = _path_matchers.get(setting)
+    # Like the attribute plan, also catch settings that were assigned directly.
+    if matcher is None or matcher[0] is not paths:
+        matcher = (paths, compile_paths(paths))
+        _path_matchers[setting] = matcher
+    return matcher[1]
+
+
+def path_matches(setting, path):
+    matcher = get_path_matcher(setting)
+    return matcher is not None and matcher.match(path) is not None
+
+
+def reset_path_matchers(setting, **kwargs):
+    """
+    ``setting_changed`` receiver throwing away a compiled pattern.
+    """
+    _path_matchers.pop(setting, None)
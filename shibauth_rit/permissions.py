@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import time
+from collections import namedtuple
+
+# Third Party Library Imports
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+# First Party Library Imports
+from shibauth_rit.attributes import parse_request
+from shibauth_rit.conf import settings
+from shibauth_rit.utils import fingerprint, is_shared_cache
+
+SESSION_KEY = 'shib_permissions'
+VERSION_KEY = 'shibauth_rit:permissions:version'
+USER_VERSION_KEY = 'shibauth_rit:permissions:version:%s'
+
+PermissionSnapshot = namedtuple('PermissionSnapshot', [
+    'version',            # [group fingerprint, global version, user version] it was taken at
+    'groups',             # frozenset of the names of the user's groups
+    'user_permissions',   # frozenset of 'app_label.codename' granted to the user
+    'group_permissions',  # frozenset of 'app_label.codename' granted to the user's groups
+])
+
+
+def _version_cache():
+    return caches[getattr(settings, "SHIBAUTH_CACHE_ALIAS") or 'default']
+
+
+def permission_snapshot_enabled():
+    """
+    Whether ``SHIBAUTH_PERMISSION_SNAPSHOT`` is set and the version is kept in a
+    cache every process shares.  With a per-process cache, a change bumped by one
+    process would never reach the snapshots read by the others.
+    """
+    if not getattr(settings, "SHIBAUTH_PERMISSION_SNAPSHOT"):
+        return False
+    return is_shared_cache(_version_cache())
+
+
+def check_permission_snapshot():
+    """
+    Refuse to start with ``SHIBAUTH_PERMISSION_SNAPSHOT`` and a per-process cache.
+    """
+    if getattr(settings, "SHIBAUTH_PERMISSION_SNAPSHOT") and not permission_snapshot_enabled():
+        raise ImproperlyConfigured(
+            ('`SHIBAUTH_PERMISSION_SNAPSHOT` needs a cache shared by every process,'
+             ' set `SHIBAUTH_CACHE_ALIAS` to a memcached, redis or database cache.'))
+
+
+def get_permissions_version():
+    """
+    Return the global version of the groups and permissions, which is bumped
+    whenever any of them changes.
+    """
+    cache = _version_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Start from the clock, so a version lost by the cache isn't reused.
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def _bump(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Start from the clock, so a version lost by the cache isn't reused.
+        cache.add(key, int(time.time() * 1000), None)
+
+
+def bump_permissions_version(*args, **kwargs):
+    """
+    Invalidate every snapshot.  Connected to the signals sent when groups or
+    their permissions change.
+    """
+    if permission_snapshot_enabled():
+        _bump(_version_cache(), VERSION_KEY)
+
+
+def bump_user_permissions_version(user_pks):
+    """
+    Invalidate the snapshots of the users with the primary keys ``user_pks``,
+    after their memberships or permissions changed.
+    """
+    if permission_snapshot_enabled():
+        cache = _version_cache()
+        for pk in user_pks:
+            _bump(cache, USER_VERSION_KEY % pk)
+
+
+def bump_membership_version(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    ``m2m_changed`` receiver for the groups and permissions of the users,
+    invalidating the snapshots of the users whose memberships changed.
+    """
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        bump_user_permissions_version([instance.pk])
+    elif pk_set:
+        bump_user_permissions_version(pk_set)
+    elif action == 'post_clear':
+        # The cleared users aren't known.
+        bump_permissions_version()
+
+
+def take_permission_snapshot(user, version):
+    backend = ModelBackend()
+    return {
+        'version': version,
+        'groups': sorted(user.groups.values_list('name', flat=True)),
+        'user_permissions': sorted(backend.get_user_permissions(user)),
+        'group_permissions': sorted(backend.get_group_permissions(user)),
+    }
+
+
+def attach_permission_snapshot(request, user, refresh=False):
+    """
+    Attach the snapshot of the user's groups and permissions stored in the
+    session to ``user``, taking a new one if ``refresh`` is set or if the group
+    attributes of the request, the global version or the user's version changed
+    since.
+    """
+    user_key = USER_VERSION_KEY % user.pk
+    versions = _version_cache().get_many([VERSION_KEY, user_key])
+    global_version = versions.get(VERSION_KEY)
+    if global_version is None:
+        global_version = get_permissions_version()
+    version = [fingerprint(parse_request(request).groups), global_version, versions.get(user_key)]
+    data = request.session.get(SESSION_KEY)
+    if refresh or data is None or data['version'] != version:
+        data = take_permission_snapshot(user, version)
+        request.session[SESSION_KEY] = data
+    user._shibauth_permissions = PermissionSnapshot(
+        version=data['version'],
+        groups=frozenset(data['groups']),
+        user_permissions=frozenset(data['user_permissions']),
+        group_permissions=frozenset(data['group_permissions']),
+    )
+    return user._shibauth_permissions
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import logging
+import threading
+
+# Third Party Library Imports
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+from django.utils import six
+from django.utils.module_loading import import_string
+
+# First Party Library Imports
+from shibauth_rit.conf import settings
+from shibauth_rit.workers import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def make_profile(middleware_path, user_pk, shib_meta):
+    """
+    Call ``make_profile`` of the middleware at ``middleware_path`` for the user
+    with the primary key ``user_pk``.  Every argument is serializable, so this
+    is what task queue executors run on their workers.
+    """
+    User = get_user_model()
+    try:
+        user = User._default_manager.get(pk=user_pk)
+    except User.DoesNotExist:
+        logger.warning('User %r no longer exists, not making its profile', user_pk)
+        return
+    import_string(middleware_path)().make_profile(user, shib_meta)
+
+
+class BaseProfileExecutor(object):
+    """
+    Runs the ``make_profile`` calls that ``ShibauthRitMiddleware`` defers once
+    the login is committed.  Subclass it to hand them to a task queue, e.g.
+    with a Celery task calling ``shibauth_rit.profiles.make_profile``::
+
+        class CeleryProfileExecutor(BaseProfileExecutor):
+
+            def submit(self, middleware_path, user_pk, shib_meta):
+                make_profile_task.delay(middleware_path, user_pk, shib_meta)
+    """
+
+    def submit(self, middleware_path, user_pk, shib_meta):
+        raise NotImplementedError('subclasses of BaseProfileExecutor must provide a submit() method')
+
+    def close(self):
+        pass
+
+
+class ThreadPoolProfileExecutor(BaseProfileExecutor):
+    """
+    Make the profiles on background threads of the web process.  When the queue
+    is full the profile is made right away instead.
+    """
+
+    def __init__(self, workers=2, max_queue_size=100):
+        self.pool = WorkerPool(workers, max_queue_size, name='shibauth-rit-profile')
+
+    def submit(self, middleware_path, user_pk, shib_meta):
+        if not self.pool.submit(self.run, middleware_path, user_pk, shib_meta):
+            make_profile(middleware_path, user_pk, shib_meta)
+
+    @staticmethod
+    def run(middleware_path, user_pk, shib_meta):
+        close_old_connections()
+        try:
+            make_profile(middleware_path, user_pk, shib_meta)
+        finally:
+            close_old_connections()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def get_profile_executor():
+    """
+    Return the executor configured by ``SHIBAUTH_PROFILE_EXECUTOR``, either a
+    dotted path or a ``(dotted path, keyword arguments)`` pair, or None if
+    profiles are made during the login.
+    """
+    global _executor
+    executor = getattr(settings, "SHIBAUTH_PROFILE_EXECUTOR")
+    if not executor:
+        return None
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                path, kwargs = (executor, {}) if isinstance(executor, six.string_types) else executor
+                _executor = import_string(path)(**kwargs)
+    return _executor
+
+
+def reset_profile_executor(setting, **kwargs):
+    """
+    ``setting_changed`` receiver closing the executor so it's rebuilt from the
+    new settings.
+    """
+    global _executor
+    if setting == 'SHIBAUTH_PROFILE_EXECUTOR':
+        with _executor_lock:
+            executor, _executor = _executor, None
+        if executor is not None:
+            executor.close()
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+# Third Party Library Imports
+from django.dispatch import Signal
+
+# Sent by ShibauthRitMiddleware after each phase of a login, see shibauth_rit.instrumentation.
+login_phase_finished = Signal(providing_args=['request', 'phase', 'duration', 'queries'])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import hashlib
+
+# Third Party Library Imports
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+# First Party Library Imports
+from shibauth_rit.conf import settings
+
+FORCE_REAUTH_SALT = 'shibauth_rit.force_reauth'
+
+
+def fingerprint(values):
+    """
+    Return a stable hash of an iterable of strings, independent of their order
+    and of duplicates.
+    """
+    data = u'\x00'.join(sorted(set(values)))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def is_shared_cache(cache):
+    """
+    Whether ``cache`` can be shared by every process, unlike the local memory
+    and dummy caches.
+    """
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def is_reauth_forced(request):
+    """
+    Whether the user logged out and must authenticate with Shibboleth again.
+    With ``SHIBAUTH_FORCE_REAUTH_COOKIE`` this is read from a signed cookie
+    instead of the session, so the session isn't loaded.
+    """
+    cookie = getattr(settings, "SHIBAUTH_FORCE_REAUTH_COOKIE")
+    if cookie:
+        return request.get_signed_cookie(
+            cookie, default=None, salt=FORCE_REAUTH_SALT,
+            max_age=getattr(settings, "SHIBAUTH_FORCE_REAUTH_COOKIE_AGE")) is not None
+    session_key = getattr(settings, "SHIBAUTH_LOGOUT_SESSION_KEY")
+    if request.session.get(session_key):
+        return True
+    # Delete the shib reauth session key if present.
+    request.session.pop(session_key, None)
+    return False
+
+
+def force_reauth(request, response):
+    """
+    Make the middleware ignore the Shibboleth headers until ``clear_reauth``.
+    """
+    cookie = getattr(settings, "SHIBAUTH_FORCE_REAUTH_COOKIE")
+    if cookie:
+        response.set_signed_cookie(
+            cookie, '1', salt=FORCE_REAUTH_SALT, max_age=getattr(settings, "SHIBAUTH_FORCE_REAUTH_COOKIE_AGE"),
+            path=settings.SESSION_COOKIE_PATH, secure=settings.SESSION_COOKIE_SECURE, httponly=True)
+    else:
+        request.session[getattr(settings, "SHIBAUTH_LOGOUT_SESSION_KEY")] = True
+
+
+def clear_reauth(request, response):
+    cookie = getattr(settings, "SHIBAUTH_FORCE_REAUTH_COOKIE")
+    if cookie:
+        if cookie in request.COOKIES:
+            response.delete_cookie(cookie, path=settings.SESSION_COOKIE_PATH)
+    else:
+        request.session.pop(getattr(settings, "SHIBAUTH_LOGOUT_SESSION_KEY"), None)
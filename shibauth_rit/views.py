@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 # Third Party Library Imports
-import requests
 from django.contrib import auth
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import redirect
@@ -11,6 +10,8 @@ from django.views.generic import TemplateView
 
 # First Party Library Imports
 from shibauth_rit.conf import settings
+from shibauth_rit.notifier import get_logout_notifier
+from shibauth_rit.utils import clear_reauth, force_reauth
 
 
 class ShibView(TemplateView):
@@ -44,11 +45,12 @@ class ShibLoginView(TemplateView):
     redirect_field_name = settings.SHIBAUTH_REDIRECT_FIELD_NAME
 
     def get(self, *args, **kwargs):
-        # Remove session value that is forcing Shibboleth reauthentication.
-        self.request.session.pop(getattr(settings, "SHIBAUTH_LOGOUT_SESSION_KEY"), None)
         login = getattr(settings, "SHIBAUTH_LOGIN_URL") + "?target={}".format(
             quote(self.request.GET.get(self.redirect_field_name, settings.LOGIN_REDIRECT_URL)))
-        return redirect(login)
+        response = redirect(login)
+        # Remove the flag that is forcing Shibboleth reauthentication.
+        clear_reauth(self.request, response)
+        return response
 
 
 class ShibLogoutView(TemplateView):
@@ -61,10 +63,14 @@ class ShibLogoutView(TemplateView):
     def get(self, request, *args, **kwargs):
         # Log the user out.
         auth.logout(self.request)
-        # Set session key that middleware will use to force
-        # Shibboleth reauthentication.
-        self.request.session[getattr(settings, "SHIBAUTH_LOGOUT_SESSION_KEY")] = True
         # Get logout redirect url
         next = getattr(settings, "SHIBAUTH_LOGOUT_REDIRECT_URL")
-        requests.post('https://shibboleth.main.ad.rit.edu/logout.html', data='')
-        return redirect(next)
+        response = redirect(next)
+        # Set the session key or cookie that middleware will use to force
+        # Shibboleth reauthentication.
+        force_reauth(self.request, response)
+        # Tell the identity provider in the background instead of making the user wait.
+        notifier = get_logout_notifier()
+        if notifier is not None:
+            notifier.notify()
+        return response
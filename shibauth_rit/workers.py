@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import logging
+import os
+import threading
+
+# Third Party Library Imports
+from django.utils.six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """
+    Run callables on a fixed number of daemon threads fed by a bounded queue.
+
+    The threads are started on the first ``submit`` and restarted if the
+    process has forked since, so a pool created at import time keeps working
+    under preforking servers.
+    """
+
+    def __init__(self, workers=1, max_queue_size=100, name='shibauth-rit'):
+        self.workers = workers
+        self.name = name
+        self.queue = queue.Queue(max_queue_size)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._threads = []
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue ``func(*args, **kwargs)``.  Returns False and drops the call if
+        the queue is full.
+        """
+        self._start()
+        try:
+            self.queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            logger.warning('%s queue is full, dropping %r', self.name, func)
+            return False
+        return True
+
+    def join(self):
+        """
+        Block until every queued call has run.
+        """
+        self.queue.join()
+
+    def shutdown(self):
+        """
+        Stop the threads once the calls queued so far have run.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+            self._pid = None
+            for _ in threads:
+                self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name='%s-%d' % (self.name, i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                func, args, kwargs = item
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('%s failed to run %r', self.name, item[0])
+            finally:
+                self.queue.task_done()
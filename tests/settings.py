@@ -3,6 +3,10 @@
 # Future Imports
 from __future__ import unicode_literals, absolute_import
 
+# Standard Library Imports
+import os
+import tempfile
+
 # Third Party Library Imports
 import django
 
@@ -17,7 +21,23 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": ":memory:",
-    }
+    },
+    # Stands in for a read replica or another database in the multi-database tests.
+    "other": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": ":memory:",
+    },
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Stands in for a cache every process shares.
+    "shared": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(tempfile.gettempdir(), "shibauth-rit-tests"),
+    },
 }
 
 TEMPLATES = [
@@ -88,6 +108,9 @@ SHIBAUTH_LOGIN_URL = 'https://localhost:8000/Shibboleth.sso/Login'
 
 SHIBAUTH_REMOTE_USER_HEADER = "uid"
 
+# Tests that need the identity provider point this at a local server.
+SHIBAUTH_LOGOUT_NOTIFY_URL = None
+
 SAMPLE_HEADERS = {
     "applicationID": "default",
     "authenticationMethod": "urn:oasis:names:tc:SAML:2.0:ac:classes:unspecified",
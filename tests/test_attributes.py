@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+from unittest import skipIf
+
+# Third Party Library Imports
+from django.conf import settings
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.utils import six
+
+# First Party Library Imports
+from shibauth_rit.attributes import get_attribute_plan, parse_headers, parse_request
+from shibauth_rit.middleware import ShibauthRitMiddleware
+
+
+class TestAttributePlan(SimpleTestCase):
+
+    @override_settings(SHIBAUTH_ATTRIBUTE_MAP={
+        "uid": (True, "username"),
+        "mail": (False, "email"),
+        "idp": (False, "idp"),
+        "memberOf": (False, "groups"),
+    })
+    def test_plan(self):
+        plan = get_attribute_plan()
+        self.assertEqual(
+            sorted(plan.headers),
+            [('idp', 'idp', False), ('mail', 'email', False),
+             ('memberOf', 'groups', False), ('uid', 'username', True)])
+        self.assertEqual(plan.required_fields, ('username',))
+        # Attributes that aren't concrete User fields are only parsed.
+        self.assertEqual(plan.optional_fields, ('email',))
+
+    def test_plan_is_reused(self):
+        self.assertIs(get_attribute_plan(), get_attribute_plan())
+
+    def test_plan_follows_setting_changes(self):
+        plan = get_attribute_plan()
+        with self.settings(SHIBAUTH_ATTRIBUTE_MAP={"uid": (True, "username")}):
+            self.assertEqual(get_attribute_plan().headers, (('uid', 'username', True),))
+        self.assertEqual(get_attribute_plan().headers, plan.headers)
+        self.assertIs(get_attribute_plan().attribute_map, settings.SHIBAUTH_ATTRIBUTE_MAP)
+
+
+@override_settings(
+    SHIBAUTH_ATTRIBUTE_MAP={'uid': (True, 'username'), 'mail': (False, 'email')},
+    SHIBAUTH_GROUP_ATTRIBUTES=['memberOf', 'unscopedAffiliation'])
+class TestParseHeaders(SimpleTestCase):
+
+    def test_parse_headers(self):
+        attributes = parse_headers({
+            'uid': 'rrcdis1',
+            'mail': '',
+            'memberOf': 'a;b;;a',
+            'unscopedAffiliation': 'b;c',
+        })
+        self.assertEqual(attributes.meta, {'username': ('rrcdis1', True)})
+        self.assertEqual(attributes.groups, frozenset(['a', 'b', 'c']))
+        self.assertFalse(attributes.error)
+        with self.assertRaises(AttributeError):
+            attributes.groups = frozenset()
+
+    def test_missing_required_attribute(self):
+        attributes = parse_headers({'memberOf': 'a'})
+        self.assertTrue(attributes.error)
+        self.assertEqual(attributes.groups, frozenset(['a']))
+
+    def test_escaped_delimiter(self):
+        self.assertEqual(parse_headers({'memberOf': r'a\;b;c'}).groups, frozenset(['a;b', 'c']))
+
+    @override_settings(SHIBAUTH_GROUP_DELIMITER=',')
+    def test_delimiter(self):
+        self.assertEqual(parse_headers({'memberOf': r'a;b,c\,d'}).groups, frozenset(['a;b', 'c,d']))
+
+    def test_parsed_once_per_request(self):
+        request = RequestFactory().get('/', uid='rrcdis1', memberOf='a;b')
+        attributes = parse_request(request)
+        self.assertIs(parse_request(request), attributes)
+        self.assertEqual(ShibauthRitMiddleware.parse_attributes(request), (attributes.meta, False))
+        self.assertEqual(ShibauthRitMiddleware.parse_group_attributes(request), ['a', 'b'])
+
+    @skipIf(six.PY2, 'Python 2 has no read-only mapping')
+    def test_parsed_attributes_are_read_only(self):
+        request = RequestFactory().get('/', uid='rrcdis1')
+        with self.assertRaises(TypeError):
+            parse_request(request).meta['username'] = ('someoneelse', True)
+
+    def test_middleware_copies_parsed_attributes(self):
+        # The middleware hands out copies, e.g. to make_profile.
+        request = RequestFactory().get('/', uid='rrcdis1')
+        shib_meta, _ = ShibauthRitMiddleware.parse_attributes(request)
+        shib_meta['username'] = ('someoneelse', True)
+        self.assertEqual(parse_request(request).meta['username'], ('rrcdis1', True))
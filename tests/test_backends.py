@@ -1,14 +1,27 @@
 # -*- coding: utf-8 -*-
 
+# Standard Library Imports
+import threading
+import time
+
 # Third Party Library Imports
+import mock
 from django.conf import settings
 from django.contrib import auth
 from django.contrib.auth.models import User
-from django.test import RequestFactory, TestCase, override_settings
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import caches
+from django.db import OperationalError, connection
+from django.db.models.signals import post_save
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 # First Party Library Imports
+from shibauth_rit.attributes import attributes_fingerprint
+from shibauth_rit.cache import get_shared_user_cache, get_user_cache, reset_user_cache
 from shibauth_rit.compat import reverse
 from shibauth_rit.middleware import ShibauthRitMiddleware
+from shibauth_rit.models import GroupSyncState
 
 try:
     from importlib import reload  # python 3.4+
@@ -115,6 +128,30 @@ class TestShibauthRitBackend(TestCase):
         user2 = auth.authenticate(remote_user='sampledeveloper@school.edu', shib_meta=shib_meta)
         self.assertEqual(user2.email, 'rrcdis1@rit.edu')
 
+    def test_unchanged_attributes_are_not_saved(self):
+        shib_meta = self._get_valid_shib_meta(location=reverse('shibauth_rit:shibauth_info'))
+        auth.authenticate(remote_user='sampledeveloper@school.edu', shib_meta=shib_meta)
+        # Only the user lookup, no write.
+        with self.assertNumQueries(1):
+            auth.authenticate(remote_user='sampledeveloper@school.edu', shib_meta=shib_meta)
+
+    def test_only_changed_attributes_are_saved(self):
+        shib_meta = self._get_valid_shib_meta(location=reverse('shibauth_rit:shibauth_info'))
+        user = auth.authenticate(remote_user='sampledeveloper@school.edu', shib_meta=shib_meta)
+        User.objects.filter(pk=user.pk).update(email='old@school.edu', first_name='Old')
+        with CaptureQueriesContext(connection) as queries:
+            user = auth.authenticate(remote_user='sampledeveloper@school.edu', shib_meta=shib_meta)
+        self.assertEqual(len(queries), 2)
+        update = queries[1]['sql']
+        self.assertTrue(update.startswith('UPDATE'))
+        self.assertIn('"email"', update)
+        self.assertIn('"first_name"', update)
+        self.assertNotIn('"last_name"', update)
+        self.assertNotIn('"password"', update)
+        user = User.objects.get(pk=user.pk)
+        self.assertEqual(user.email, 'rrcdis1@rit.edu')
+        self.assertEqual(user.first_name, 'Sample')
+
     def test_change_required_attributes(self):
         shib_meta = self._get_valid_shib_meta(location=reverse('shibauth_rit:shibauth_info'))
         user = auth.authenticate(remote_user='sampledeveloper@school.edu', shib_meta=shib_meta)
@@ -124,6 +161,339 @@ class TestShibauthRitBackend(TestCase):
         self.assertEqual(user.email, 'rrcdis1@rit.edu')
 
 
+@override_settings(SHIBAUTH_USER_CACHE_SIZE=2)
+class TestUserCache(TestCase):
+
+    def setUp(self):
+        test_request = RequestFactory().get('/')
+        test_request.META.update(**settings.SAMPLE_HEADERS)
+        self.shib_meta, _ = ShibauthRitMiddleware.parse_attributes(test_request)
+        # The cache outlives the rolled back test transactions.
+        reset_user_cache('SHIBAUTH_USER_CACHE_SIZE')
+        self.cache = get_user_cache()
+
+    def authenticate(self, username='sampledeveloper', shib_meta=None):
+        return auth.authenticate(remote_user=username, shib_meta=shib_meta or self.shib_meta)
+
+    def test_hit_skips_database(self):
+        user = self.authenticate()
+        with self.assertNumQueries(0):
+            cached = self.authenticate()
+        self.assertEqual(cached, user)
+        self.assertIsNot(cached, user)
+        self.assertEqual(cached.email, 'rrcdis1@rit.edu')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_changed_attributes_miss(self):
+        self.authenticate()
+        shib_meta = dict(self.shib_meta, email=('new@rit.edu', False))
+        user = self.authenticate(shib_meta=shib_meta)
+        self.assertEqual(user.email, 'new@rit.edu')
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+    def test_save_invalidates(self):
+        user = self.authenticate()
+        user.is_active = False
+        user.save()
+        self.assertIsNone(self.authenticate())
+        cached = self.cache.get('sampledeveloper', attributes_fingerprint(self.shib_meta))
+        self.assertFalse(cached.is_active)
+
+    def test_last_login_update_keeps_entry(self):
+        user = self.authenticate()
+        user_logged_in.send(sender=User, request=None, user=user)
+        with self.assertNumQueries(0):
+            self.authenticate()
+
+    def test_delete_invalidates(self):
+        self.authenticate().delete()
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_eviction(self):
+        for username in ('one', 'two', 'three'):
+            self.authenticate(username)
+        self.assertEqual(self.cache.stats()['size'], 2)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        with self.assertNumQueries(0):
+            self.authenticate('three')
+        self.assertEqual(self.cache.get('one', attributes_fingerprint(self.shib_meta)), None)
+
+    @override_settings(SHIBAUTH_USER_CACHE_TIMEOUT=0)
+    def test_timeout(self):
+        self.authenticate()
+        self.assertEqual(self.cache.get('sampledeveloper', attributes_fingerprint(self.shib_meta)), None)
+
+    @override_settings(SHIBAUTH_USER_CACHE_SIZE=0)
+    def test_disabled(self):
+        self.assertIsNone(get_user_cache())
+
+
+@override_settings(SHIBAUTH_CACHE_ALIAS='default', SHIBAUTH_SHARED_USER_CACHE=True)
+class TestSharedUserCache(TestCase):
+
+    def setUp(self):
+        test_request = RequestFactory().get('/')
+        test_request.META.update(**settings.SAMPLE_HEADERS)
+        self.shib_meta, _ = ShibauthRitMiddleware.parse_attributes(test_request)
+        self.fingerprint = attributes_fingerprint(self.shib_meta)
+        caches['default'].clear()
+        self.cache = get_shared_user_cache()
+
+    def authenticate(self, username='sampledeveloper'):
+        return auth.authenticate(remote_user=username, shib_meta=self.shib_meta)
+
+    def test_hit_skips_database(self):
+        user = self.authenticate()
+        with self.assertNumQueries(0):
+            cached = self.authenticate()
+        self.assertEqual(cached, user)
+        self.assertEqual(cached.email, 'rrcdis1@rit.edu')
+
+    def test_password_is_not_shared(self):
+        user = self.authenticate()
+        entry = caches['default'].get(self.cache._user_key('sampledeveloper'))
+        self.assertEqual(dict(zip(entry[4], entry[3])), {
+            'id': user.pk, 'username': 'sampledeveloper', 'is_active': True, 'is_staff': False, 'is_superuser': False})
+        cached = self.cache.get('sampledeveloper', self.fingerprint)
+        self.assertIn('password', cached.get_deferred_fields())
+        with self.assertNumQueries(1):
+            self.assertEqual(cached.password, user.password)
+
+    def test_single_fetch(self):
+        self.authenticate()
+        with mock.patch.object(caches['default'], 'get_many', wraps=caches['default'].get_many) as get_many:
+            self.assertIsNotNone(self.cache.get('sampledeveloper', self.fingerprint))
+        self.assertEqual(get_many.call_count, 1)
+
+    def test_save_invalidates(self):
+        user = self.authenticate()
+        user.username = 'renamed'
+        user.save()
+        self.assertIsNone(self.cache.get('sampledeveloper', self.fingerprint))
+
+    def test_invalidate_all(self):
+        self.authenticate('one')
+        self.authenticate('two')
+        self.cache.invalidate_all()
+        self.assertIsNone(self.cache.get('one', self.fingerprint))
+        self.assertIsNone(self.cache.get('two', self.fingerprint))
+        self.authenticate('one')
+        self.assertIsNotNone(self.cache.get('one', self.fingerprint))
+
+    @override_settings(SHIBAUTH_SHARED_USER_CACHE=False)
+    def test_disabled(self):
+        self.assertIsNone(get_shared_user_cache())
+        user = self.authenticate()
+        with mock.patch.object(caches['default'], 'get') as get:
+            user.save()
+        self.assertFalse(get.called)
+
+    @override_settings(SHIBAUTH_USER_CACHE_SIZE=10)
+    def test_fills_local_cache(self):
+        self.authenticate()
+        # Another process starts with an empty local cache.
+        reset_user_cache('SHIBAUTH_USER_CACHE_SIZE')
+        with self.assertNumQueries(0):
+            self.authenticate()
+        self.assertIsNotNone(get_user_cache().get('sampledeveloper', self.fingerprint))
+
+
+@override_settings(SHIBAUTH_UPSERT_USERS=True)
+class TestUpsertUsers(TestCase):
+
+    def setUp(self):
+        test_request = RequestFactory().get('/')
+        test_request.META.update(**settings.SAMPLE_HEADERS)
+        self.shib_meta, _ = ShibauthRitMiddleware.parse_attributes(test_request)
+        self.backend = backends.ShibauthRitBackend()
+
+    def authenticate(self, username='sampledeveloper'):
+        return self.backend.authenticate(remote_user=username, shib_meta=self.shib_meta)
+
+    def test_new_user(self):
+        created = []
+
+        def receiver(sender, instance, **kwargs):
+            if kwargs['created']:
+                created.append(instance)
+        post_save.connect(receiver, sender=User)
+        self.addCleanup(post_save.disconnect, receiver, sender=User)
+        # The lookup and the upsert.
+        with self.assertNumQueries(2):
+            user = self.authenticate()
+        self.assertEqual(created, [user])
+        self.assertEqual(User.objects.get(), user)
+        self.assertEqual(user.email, 'rrcdis1@rit.edu')
+        self.assertEqual(user.first_name, 'Sample')
+        self.assertFalse(User.objects.get().has_usable_password())
+        self.assertTrue(User.objects.get().is_active)
+        self.assertFalse(user._state.adding)
+
+    def test_existing_user(self):
+        self.authenticate()
+        with self.assertNumQueries(1):
+            self.authenticate()
+        self.shib_meta['email'] = ('new@rit.edu', False)
+        with self.assertNumQueries(2):
+            user = self.authenticate()
+        self.assertEqual(User.objects.get().email, user.email)
+
+    def test_concurrently_created_user(self):
+        existing = User.objects.create(username='sampledeveloper', email='old@rit.edu', password='secret')
+        created = []
+
+        def receiver(sender, instance, **kwargs):
+            created.append(kwargs['created'])
+        post_save.connect(receiver, sender=User)
+        self.addCleanup(post_save.disconnect, receiver, sender=User)
+        # Another request created the user after the lookup.
+        with mock.patch.object(User._default_manager, 'get_by_natural_key', side_effect=User.DoesNotExist):
+            user = self.authenticate()
+        self.assertEqual(created, [False])
+        self.assertEqual(user.pk, existing.pk)
+        self.assertEqual(user.email, 'rrcdis1@rit.edu')
+        self.assertEqual(User.objects.get().email, 'rrcdis1@rit.edu')
+        # The password of the existing user is left alone.
+        self.assertEqual(user.password, existing.password)
+
+    def test_multi_table_inheritance(self):
+        with mock.patch.object(User._meta, 'parents', {object(): None}):
+            self.assertFalse(self.backend.can_upsert())
+
+    def test_unsupported_database(self):
+        with mock.patch.object(backends, 'supports_upsert', return_value=False):
+            with mock.patch.object(self.backend, 'upsert_user') as upsert_user:
+                user = self.authenticate()
+        self.assertFalse(upsert_user.called)
+        self.assertEqual(User.objects.get(), user)
+
+
+@override_settings(SHIBAUTH_UPSERT_USERS=True)
+class TestConcurrentUpserts(TransactionTestCase):
+
+    def test_concurrent_first_logins(self):
+        self.run_concurrent_logins()
+
+    def run_concurrent_logins(self, threads=8):
+        start = threading.Event()
+        users = []
+        errors = []
+
+        def login():
+            start.wait()
+            try:
+                while True:
+                    try:
+                        with CaptureQueriesContext(connection) as queries:
+                            user = backends.ShibauthRitBackend().authenticate(remote_user='crowd', shib_meta={})
+                        break
+                    except OperationalError as e:
+                        # The threads share the in memory SQLite database, which
+                        # locks whole tables instead of waiting for each other.
+                        if connection.vendor != 'sqlite' or 'locked' not in str(e):
+                            raise
+                        time.sleep(0.01)
+                users.append(user)
+                # The lookup, the upsert and, if it lost the race, reading the user.
+                self.assertLessEqual(len(queries), 3)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=login) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        start.set()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(user.pk for user in users)), 1)
+        self.assertEqual(User.objects.filter(username='crowd').count(), 1)
+
+
+@override_settings(
+    SHIBAUTH_READ_DATABASE='other',
+    SHIBAUTH_ATTRIBUTE_MAP={'uid': (True, 'username'), 'mail': (False, 'email')},
+    SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'],
+)
+class TestReadReplica(TestCase):
+    multi_db = True
+    databases = {'default', 'other'}
+
+    def setUp(self):
+        self.request = RequestFactory().get('/', **settings.SAMPLE_HEADERS)
+        self.shib_meta, _ = ShibauthRitMiddleware.parse_attributes(self.request)
+        self.backend = backends.ShibauthRitBackend()
+
+    def create_user(self, email='rrcdis1@rit.edu', replica_email='rrcdis1@rit.edu'):
+        user = User.objects.create(username='rrcdis1', email=email)
+        User.objects.using('other').create(pk=user.pk, username='rrcdis1', email=replica_email)
+        return user
+
+    def authenticate(self):
+        return self.backend.authenticate(remote_user='rrcdis1', shib_meta=self.shib_meta)
+
+    def test_unchanged_user_is_read_from_replica(self):
+        user = self.create_user()
+        with self.assertNumQueries(0, using='default'), self.assertNumQueries(1, using='other'):
+            authenticated = self.authenticate()
+        self.assertEqual(authenticated.pk, user.pk)
+        # Saving the user writes to the primary.
+        self.assertEqual(authenticated._state.db, 'default')
+
+    def test_changed_user_is_saved_on_primary(self):
+        user = self.create_user(email='old@rit.edu', replica_email='old@rit.edu')
+        with self.assertNumQueries(1, using='default'):
+            self.authenticate()
+        self.assertEqual(User.objects.get(pk=user.pk).email, 'rrcdis1@rit.edu')
+        self.assertEqual(User.objects.using('other').get(pk=user.pk).email, 'old@rit.edu')
+
+    def test_missing_on_replica_falls_back_to_primary(self):
+        user = User.objects.create(username='rrcdis1', email='rrcdis1@rit.edu')
+        self.assertEqual(self.authenticate().pk, user.pk)
+        User.objects.all().delete()
+        self.assertIsNotNone(self.authenticate())
+        self.assertEqual(User.objects.count(), 1)
+        self.assertEqual(User.objects.using('other').count(), 0)
+
+    @override_settings(SHIBAUTH_READ_DATABASE_CHECK_ACTIVE=True)
+    def test_deactivated_on_primary(self):
+        user = self.create_user()
+        User.objects.filter(pk=user.pk).update(is_active=False)
+        self.assertIsNone(self.authenticate())
+
+    @override_settings(SHIBAUTH_READ_DATABASE_CHECK_ACTIVE=True)
+    def test_deleted_on_primary(self):
+        user = self.create_user()
+        User.objects.filter(pk=user.pk).delete()
+        self.assertNotEqual(self.authenticate().pk, user.pk)
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_synchronized_groups_are_read_from_replica(self):
+        user = self.create_user()
+        middleware = ShibauthRitMiddleware()
+        middleware.update_user_groups(self.request, user)
+        state = GroupSyncState.objects.get(user=user)
+        GroupSyncState.objects.using('other').create(pk=state.pk, user_id=user.pk, fingerprint=state.fingerprint)
+        with self.assertNumQueries(0, using='default'), self.assertNumQueries(1, using='other'):
+            middleware.update_user_groups(self.request, user)
+
+    def test_groups_not_yet_on_replica_are_read_from_primary(self):
+        user = self.create_user()
+        middleware = ShibauthRitMiddleware()
+        middleware.update_user_groups(self.request, user)
+        with self.assertNumQueries(1, using='default'), self.assertNumQueries(1, using='other'):
+            middleware.update_user_groups(self.request, user)
+
+    def test_disabled(self):
+        self.create_user()
+        with self.settings(SHIBAUTH_READ_DATABASE=None):
+            with self.assertNumQueries(0, using='other'):
+                self.authenticate()
+
+
 class LogoutTest(TestCase):
 
     def test_logout(self):
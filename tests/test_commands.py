@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import io
+import operator
+import os
+import shutil
+import tempfile
+from functools import reduce
+
+# Third Party Library Imports
+import mock
+from django.contrib.auth.models import Group, User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db.models import Q
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import six
+from django.utils.six import StringIO
+
+# First Party Library Imports
+from shibauth_rit.backends import ShibauthRitBackend
+from shibauth_rit.compat import reverse
+from shibauth_rit.management.commands.shibauth_provision import match_usernames
+from shibauth_rit.models import GroupSyncState
+from shibauth_rit.permissions import USER_VERSION_KEY, get_permissions_version
+
+CSV_DUMP = u"""uid,mail,givenName,sn,ritEduMemberOfUid
+rrcdis1,rrcdis1@rit.edu,Sample,Developer,forklift-operators;historyintegrator
+abc1234,abc1234@rit.edu,Another,Student,historyintegrator
+,missing@rit.edu,Missing,Username,
+"""
+
+LDIF_DUMP = u"""version: 1
+
+# A comment
+dn: uid=rrcdis1,ou=People,dc=rit,dc=edu
+uid: rrcdis1
+mail: rrcdis1@rit.edu
+givenName:: U2FtcGxl
+sn: Devel
+ oper
+ritEduMemberOfUid: forklift-operators
+ritEduMemberOfUid: historyintegrator
+
+dn: uid=abc1234,ou=People,dc=rit,dc=edu
+uid: abc1234
+mail: abc1234@rit.edu
+"""
+
+
+@override_settings(
+    SHIBAUTH_ATTRIBUTE_MAP={
+        'uid': (True, 'username'),
+        'mail': (False, 'email'),
+        'givenName': (False, 'first_name'),
+        'sn': (False, 'last_name'),
+    },
+    SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'],
+)
+class TestProvisionCommand(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def provision(self, name, content, *args):
+        path = os.path.join(self.directory, name)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        out = StringIO()
+        call_command('shibauth_provision', path, *args, stdout=out)
+        return out.getvalue().strip()
+
+    def test_csv(self):
+        output = self.provision('dump.csv', CSV_DUMP)
+        self.assertEqual(output, '2 created, 0 updated, 0 unchanged, 1 skipped.')
+        user = User.objects.get(username='rrcdis1')
+        self.assertEqual(user.email, 'rrcdis1@rit.edu')
+        self.assertEqual(user.last_name, 'Developer')
+        self.assertFalse(user.has_usable_password())
+        self.assertTrue(user.is_active)
+        self.assertEqual(
+            sorted(user.groups.values_list('name', flat=True)), ['forklift-operators', 'historyintegrator'])
+        self.assertEqual(list(User.objects.get(username='abc1234').groups.values_list('name', flat=True)),
+                         ['historyintegrator'])
+        self.assertEqual(GroupSyncState.objects.count(), 2)
+
+    def test_ldif(self):
+        output = self.provision('dump.ldif', LDIF_DUMP)
+        self.assertEqual(output, '2 created, 0 updated, 0 unchanged, 0 skipped.')
+        user = User.objects.get(username='rrcdis1')
+        self.assertEqual((user.first_name, user.last_name), ('Sample', 'Developer'))
+        self.assertEqual(
+            sorted(user.groups.values_list('name', flat=True)), ['forklift-operators', 'historyintegrator'])
+        self.assertEqual(User.objects.get(username='abc1234').groups.count(), 0)
+
+    def test_updates_only_changed_users(self):
+        self.provision('dump.csv', CSV_DUMP)
+        changed = CSV_DUMP.replace('Another,Student,historyintegrator', 'Another,Alumnus,forklift-operators')
+        output = self.provision('dump.csv', changed)
+        self.assertEqual(output, '0 created, 1 updated, 1 unchanged, 1 skipped.')
+        user = User.objects.get(username='abc1234')
+        self.assertEqual(user.last_name, 'Alumnus')
+        self.assertEqual(list(user.groups.values_list('name', flat=True)), ['forklift-operators'])
+        self.assertEqual(Group.objects.count(), 2)
+
+    def test_constant_queries_per_batch(self):
+        rows = ''.join(
+            'user%d,user%d@rit.edu,First,Last,group%d;common\n' % (i, i, i) for i in range(50))
+        path = os.path.join(self.directory, 'dump.csv')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(u'uid,mail,givenName,sn,ritEduMemberOfUid\n' + rows)
+        # Users, groups, memberships and states are read and written in bulk,
+        # the created users are fetched once more to configure them, and an
+        # unchanged dump only reads.
+        with self.assertNumQueries(22):
+            call_command('shibauth_provision', path, stdout=StringIO())
+        self.assertEqual(User.objects.count(), 50)
+        self.assertEqual(Group.objects.count(), 51)
+        self.assertEqual(User.groups.through.objects.count(), 100)
+        with self.assertNumQueries(10):
+            call_command('shibauth_provision', path, '--batch-size', '25', stdout=StringIO())
+
+    @override_settings(SHIBAUTH_PERMISSION_SNAPSHOT=True, SHIBAUTH_CACHE_ALIAS='shared')
+    def test_invalidates_permission_snapshots(self):
+        def user_versions():
+            return caches['shared'].get_many([USER_VERSION_KEY % user.pk for user in User.objects.all()])
+        version = get_permissions_version()
+        self.provision('dump.csv', CSV_DUMP)
+        versions = user_versions()
+        self.assertEqual(len(versions), 2)
+        self.provision('dump.csv', CSV_DUMP)
+        self.assertEqual(user_versions(), versions)
+        # Only the provisioned users' snapshots are invalidated.
+        self.assertEqual(get_permissions_version(), version)
+
+    @override_settings(SHIBAUTH_CREATE_UNKNOWN_USER=False)
+    def test_create_unknown_user(self):
+        User.objects.create(username='abc1234')
+        output = self.provision('dump.csv', CSV_DUMP)
+        self.assertEqual(output, '0 created, 1 updated, 0 unchanged, 2 skipped.')
+        self.assertFalse(User.objects.filter(username='rrcdis1').exists())
+        self.assertEqual(User.objects.get(username='abc1234').groups.count(), 1)
+        output = self.provision('dump.csv', CSV_DUMP, '--create')
+        self.assertEqual(output, '1 created, 0 updated, 1 unchanged, 1 skipped.')
+        self.assertEqual(User.objects.get(username='rrcdis1').groups.count(), 2)
+
+    def test_configures_created_users(self):
+        User.objects.create(username='abc1234')
+        with mock.patch.object(ShibauthRitBackend, 'configure_user') as configure_user:
+            self.provision('dump.csv', CSV_DUMP)
+        self.assertEqual([call[0][0].username for call in configure_user.call_args_list], ['rrcdis1'])
+
+    def test_case_insensitive_usernames(self):
+        self.provision('dump.csv', CSV_DUMP)
+
+        def filter_ignoring_case(username__in):
+            # What a case-insensitive collation does.
+            return User.objects.all().filter(reduce(operator.or_, (Q(username__iexact=name) for name in username__in)))
+        changed = CSV_DUMP.replace('rrcdis1,', 'RRCDIS1,').replace('historyintegrator\n', 'forklift-operators\n')
+        with mock.patch.object(User._default_manager, 'filter', side_effect=filter_ignoring_case):
+            output = self.provision('dump.csv', changed)
+        self.assertEqual(output, '0 created, 0 updated, 2 unchanged, 1 skipped.')
+        self.assertEqual(User.objects.count(), 2)
+        self.assertEqual(
+            list(User.objects.get(username='rrcdis1').groups.values_list('name', flat=True)),
+            ['forklift-operators'])
+
+    def test_stdin_encoding(self):
+        data = CSV_DUMP.replace('Sample', u'S\xe4mple').encode('latin-1')
+        stdin = io.BytesIO(data) if six.PY2 else io.TextIOWrapper(io.BytesIO(data))
+        with mock.patch('sys.stdin', stdin):
+            call_command('shibauth_provision', '-', '--encoding', 'latin-1', stdout=StringIO())
+            self.assertFalse(stdin.closed)
+        self.assertEqual(User.objects.get(username='rrcdis1').first_name, u'S\xe4mple')
+
+    def test_no_groups(self):
+        self.provision('dump.csv', CSV_DUMP, '--no-groups')
+        self.assertEqual(Group.objects.count(), 0)
+        self.assertEqual(GroupSyncState.objects.count(), 0)
+
+    def test_first_login_uses_provisioned_user(self):
+        self.provision('dump.csv', CSV_DUMP)
+        headers = {
+            'uid': 'rrcdis1',
+            'mail': 'rrcdis1@rit.edu',
+            'givenName': 'Sample',
+            'sn': 'Developer',
+            'ritEduMemberOfUid': 'forklift-operators;historyintegrator',
+        }
+        self.client.get(reverse('shibauth_rit:shibauth_info'), **headers)
+        self.assertEqual(User.objects.count(), 2)
+        user = User.objects.get(username='rrcdis1')
+        self.assertEqual(user.groups.count(), 2)
+        self.assertEqual(Group.objects.count(), 2)
+
+
+class TestMatchUsernames(SimpleTestCase):
+
+    def test_exact_match_first(self):
+        self.assertEqual(match_usernames(['Abc', 'abc'], {'abc', 'Abc'}), {'Abc': 'Abc', 'abc': 'abc'})
+
+    def test_ignoring_case(self):
+        self.assertEqual(match_usernames(['ABC', 'def'], {'abc'}), {'ABC': 'abc'})
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+# Third Party Library Imports
+import mock
+from django.template import RequestContext, Template
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+# First Party Library Imports
+from shibauth_rit import context_processors
+from shibauth_rit.compat import reverse
+
+try:
+    from django.urls import set_script_prefix
+except ImportError:
+    from django.core.urlresolvers import set_script_prefix
+
+
+class TestContextProcessors(SimpleTestCase):
+
+    def setUp(self):
+        context_processors.reset_reversed_urls()
+        self.request = RequestFactory().get('/some/page/', {'with': 'query'})
+
+    def render(self, source):
+        return Template(source).render(RequestContext(self.request, {}))
+
+    @override_settings(SHIBAUTH_LOGOUT_REDIRECT_URL=None)
+    def test_links(self):
+        self.assertEqual(
+            self.render('{{ login_link }}|{{ logout_link }}'),
+            '/shib/login/?target=/some/page/%3Fwith%3Dquery|'
+            '/shib/logout/?target=http%3A//testserver/some/page/%3Fwith%3Dquery')
+
+    @override_settings(SHIBAUTH_LOGOUT_REDIRECT_URL='https://www.rit.edu')
+    def test_logout_redirect_url(self):
+        self.assertEqual(self.render('{{ logout_link }}'), '/shib/logout/?target=https://www.rit.edu')
+
+    def test_lazy(self):
+        with mock.patch.object(context_processors, 'reverse', side_effect=reverse) as patched:
+            self.render('Nothing to see here.')
+            self.assertFalse(patched.called)
+            self.render('{{ login_link }}')
+            self.render('{{ login_link }}')
+        self.assertEqual(patched.call_count, 1)
+
+    def test_memoized_per_script_prefix(self):
+        self.render('{{ login_link }}')
+        set_script_prefix('/app/')
+        self.addCleanup(set_script_prefix, '/')
+        self.assertTrue(self.render('{{ login_link }}').startswith('/app/shib/login/'))
+        set_script_prefix('/')
+        self.assertTrue(self.render('{{ login_link }}').startswith('/shib/login/'))
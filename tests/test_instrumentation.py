@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import socket
+from collections import deque
+
+# Third Party Library Imports
+import mock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, override_settings
+
+# First Party Library Imports
+from shibauth_rit import instrumentation
+from shibauth_rit.compat import reverse
+from shibauth_rit.instrumentation import LoggingExporter, StatsdExporter
+from shibauth_rit.signals import login_phase_finished
+
+
+class RecordingExporter(instrumentation.BaseExporter):
+
+    def __init__(self, counts_queries=True):
+        self.counts_queries = counts_queries
+        self.phases = []
+
+    def export(self, phase, duration, queries):
+        self.phases.append((phase, duration, queries))
+
+
+@override_settings(
+    SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'],
+    SHIBAUTH_TIMING_EXPORTERS=['tests.test_instrumentation.RecordingExporter'],
+)
+class TestLoginPhases(TestCase):
+
+    def setUp(self):
+        [self.exporter] = instrumentation._exporters
+
+    def test_phases(self):
+        self.client.get(reverse('shibauth_rit:shibauth_info'), **settings.SAMPLE_HEADERS)
+        phases = [phase for phase, _, _ in self.exporter.phases]
+        self.assertEqual(
+            phases, ['parse_attributes', 'authenticate', 'login', 'update_user_groups', 'make_profile'])
+        queries = dict((phase, queries) for phase, _, queries in self.exporter.phases)
+        self.assertEqual(queries['parse_attributes'], 0)
+        self.assertGreater(queries['authenticate'], 0)
+        self.assertGreater(queries['update_user_groups'], 0)
+        self.assertTrue(all(duration >= 0 for _, duration, _ in self.exporter.phases))
+
+    def test_queries_not_counted(self):
+        with self.settings(SHIBAUTH_TIMING_EXPORTERS=[
+                ('tests.test_instrumentation.RecordingExporter', {'counts_queries': False})]):
+            [exporter] = instrumentation._exporters
+            with mock.patch.object(instrumentation, 'count_queries') as count_queries:
+                self.client.get(reverse('shibauth_rit:shibauth_info'), **settings.SAMPLE_HEADERS)
+        self.assertFalse(count_queries.called)
+        self.assertEqual(set(queries for _, _, queries in exporter.phases), set([None]))
+
+    def test_connection_opened_during_phase(self):
+        other = connections['other']
+        # As with CONN_MAX_AGE = 0, the connection is closed when the phase starts.
+        with mock.patch.object(other, 'connection', None):
+            with instrumentation.count_queries() as count:
+                self.assertIsNone(other.connection)
+                with other.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                self.assertIsNotNone(other.connection)
+            other.connection.close()
+        self.assertEqual(count, [1])
+
+    def test_full_query_log(self):
+        db = connections['default']
+        with mock.patch.object(db, 'queries_log', deque(range(db.queries_limit), maxlen=db.queries_limit)):
+            with instrumentation.count_queries() as count:
+                User.objects.count()
+                User.objects.count()
+        self.assertEqual(count, [2])
+
+    def test_no_phases_when_authenticated(self):
+        self.client.get(reverse('shibauth_rit:shibauth_info'), **settings.SAMPLE_HEADERS)
+        del self.exporter.phases[:]
+        self.client.get(reverse('shibauth_rit:shibauth_info'), **settings.SAMPLE_HEADERS)
+        self.assertEqual(self.exporter.phases, [])
+
+
+class TestExporters(SimpleTestCase):
+
+    def test_disabled_without_listeners(self):
+        with mock.patch.object(instrumentation, 'monotonic') as monotonic:
+            with instrumentation.timed_phase(None, 'phase'):
+                pass
+        self.assertFalse(monotonic.called)
+
+    def test_logging_exporter(self):
+        exporter = LoggingExporter()
+        with mock.patch.object(exporter, 'logger') as logger:
+            exporter.receive(sender=None, request=None, phase='login', duration=0.0125, queries=3)
+        logger.log.assert_called_once_with(20, '%s took %.2fms and %d queries', 'login', 12.5, 3)
+
+    def test_statsd_exporter(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(2)
+        self.addCleanup(server.close)
+        exporter = StatsdExporter('127.0.0.1', server.getsockname()[1], prefix='app.shib')
+        exporter.export('authenticate', 0.0125, 2)
+        data = server.recv(1024).decode('ascii')
+        self.assertEqual(data, 'app.shib.authenticate:12.500|ms\napp.shib.authenticate.queries:2|c')
+
+    def test_configured_exporters(self):
+        path = 'tests.test_instrumentation.RecordingExporter'
+        with self.settings(SHIBAUTH_TIMING_EXPORTERS=[path, ('shibauth_rit.instrumentation.StatsdExporter', {
+                'host': '127.0.0.1', 'port': 9})]):
+            exporters = list(instrumentation._exporters)
+            self.assertEqual(len(exporters), 2)
+            self.assertIsInstance(exporters[1], StatsdExporter)
+            with instrumentation.timed_phase(None, 'phase'):
+                pass
+            self.assertEqual([phase for phase, _, _ in exporters[0].phases], ['phase'])
+        self.assertEqual(instrumentation._exporters, [])
+        self.assertFalse(login_phase_finished.has_listeners())
@@ -1,13 +1,34 @@
 # -*- coding: utf-8 -*-
 
+# Standard Library Imports
+import json
+import os
+import shutil
+import tempfile
+
 # Third Party Library Imports
+import django
+import mock
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.contrib.auth.middleware import AuthenticationMiddleware
 from django.contrib.auth.models import Group, User
-from django.test import TestCase, override_settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models.signals import m2m_changed
+from django.test import RequestFactory, TestCase, TransactionTestCase, modify_settings, override_settings
 
 # First Party Library Imports
+from shibauth_rit.cache import get_user_cache, reset_user_cache
 from shibauth_rit.compat import reverse
+from shibauth_rit.groups import (GroupCatalog, bulk_create_ignoring_conflicts, check_group_catalog,
+                                 get_group_catalog, reset_group_catalog)
+from shibauth_rit.middleware import ShibauthRitMiddleware, ShibauthRitMockHeadersMiddleware
+from shibauth_rit.models import GroupSyncState
+from shibauth_rit.paths import compile_paths, get_path_matcher
+from shibauth_rit.utils import fingerprint
 
 settings.SHIBAUTH_ATTRIBUTE_MAP = {
     "idp": (False, "idp"),
@@ -20,6 +41,8 @@ settings.SHIBAUTH_ATTRIBUTE_MAP = {
     "sn": (False, "last_name"),
 }
 
+MIDDLEWARE_SETTING = 'MIDDLEWARE' if django.VERSION >= (1, 10) else 'MIDDLEWARE_CLASSES'
+
 
 class TestShibauthRitMiddleware(TestCase):
 
@@ -118,3 +141,445 @@ class TestShibauthRitMiddleware(TestCase):
         self.client.get(reverse('shibauth_rit:shibauth_info'), **settings.SAMPLE_HEADERS)
         user = User.objects.get(username='rrcdis1')
         self.assertTrue(g not in user.groups.all())
+
+
+@override_settings(SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'])
+class TestUpdateUserGroups(TestCase):
+
+    def setUp(self):
+        self.middleware = ShibauthRitMiddleware()
+        self.user = User.objects.create(username='rrcdis1')
+
+    def _request(self, groups):
+        request = RequestFactory().get('/')
+        request.META['ritEduMemberOfUid'] = ';'.join(groups)
+        return request
+
+    def _group_names(self):
+        return set(self.user.groups.values_list('name', flat=True))
+
+    def test_query_count_does_not_grow_with_groups(self):
+        few = ['group%d' % i for i in range(3)]
+        many = ['other%d' % i for i in range(100)]
+        user2 = User.objects.create(username='user2')
+        with self.assertNumQueries(13):
+            self.middleware.update_user_groups(self._request(few), self.user)
+        with self.assertNumQueries(13):
+            self.middleware.update_user_groups(self._request(many), user2)
+        self.assertEqual(self._group_names(), set(few))
+        self.assertEqual(user2.groups.count(), 100)
+
+    def test_existing_groups_are_reused(self):
+        Group.objects.create(name='existing')
+        self.middleware.update_user_groups(self._request(['existing', 'new']), self.user)
+        self.assertEqual(Group.objects.count(), 2)
+        self.assertEqual(self._group_names(), {'existing', 'new'})
+
+    def test_only_difference_is_written(self):
+        self.middleware.update_user_groups(self._request(['a', 'b', 'c']), self.user)
+        self.middleware.update_user_groups(self._request(['b', 'c', 'd']), self.user)
+        self.assertEqual(self._group_names(), {'b', 'c', 'd'})
+        # Group 'a' is left in place, only the membership is removed.
+        self.assertTrue(Group.objects.filter(name='a').exists())
+
+    def test_unchanged_groups_skip_sync(self):
+        self.middleware.update_user_groups(self._request(['a', 'b']), self.user)
+        with self.assertNumQueries(1):
+            self.middleware.update_user_groups(self._request(['b', 'a', 'a']), self.user)
+        self.assertEqual(GroupSyncState.objects.get(user=self.user).fingerprint, fingerprint(['a', 'b']))
+
+    def test_changed_groups_are_synced(self):
+        self.middleware.update_user_groups(self._request(['a', 'b']), self.user)
+        self.middleware.update_user_groups(self._request(['a']), self.user)
+        self.assertEqual(self._group_names(), {'a'})
+        self.assertEqual(GroupSyncState.objects.get(user=self.user).fingerprint, fingerprint(['a']))
+
+    def test_sync_without_state(self):
+        # Memberships that predate the fingerprint are synchronized once.
+        self.user.groups.add(Group.objects.create(name='stale'))
+        self.middleware.update_user_groups(self._request(['a']), self.user)
+        self.assertEqual(self._group_names(), {'a'})
+
+    def test_duplicate_group_values(self):
+        self.middleware.update_user_groups(self._request(['a', 'a', 'b']), self.user)
+        self.assertEqual(self._group_names(), {'a', 'b'})
+
+    def test_sends_m2m_changed(self):
+        self.middleware.update_user_groups(self._request(['a', 'b']), self.user)
+        Group.objects.create(name='c')
+        group_ids = dict(Group.objects.values_list('name', 'pk'))
+        sent = []
+
+        def receiver(instance, action, reverse, pk_set, **kwargs):
+            sent.append((instance, action, reverse, pk_set))
+        m2m_changed.connect(receiver, sender=User.groups.through)
+        self.addCleanup(m2m_changed.disconnect, receiver, sender=User.groups.through)
+        self.middleware.update_user_groups(self._request(['b', 'c']), self.user)
+        self.assertEqual(sent, [
+            (self.user, 'pre_remove', False, {group_ids['a']}),
+            (self.user, 'post_remove', False, {group_ids['a']}),
+            (self.user, 'pre_add', False, {group_ids['c']}),
+            (self.user, 'post_add', False, {group_ids['c']}),
+        ])
+
+
+# The catalog needs a cache every process shares.
+SHARED_DEFAULT_CACHES = dict(settings.CACHES, default=settings.CACHES['shared'])
+
+
+@override_settings(SHIBAUTH_GROUP_CATALOG=True, CACHES=SHARED_DEFAULT_CACHES)
+class TestUpdateUserGroupsWithCatalog(TestUpdateUserGroups):
+
+    def setUp(self):
+        super(TestUpdateUserGroupsWithCatalog, self).setUp()
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+        # The catalog outlives the rolled back test transactions.
+        reset_group_catalog('SHIBAUTH_GROUP_CATALOG')
+        self.catalog = get_group_catalog()
+
+    def test_query_count_does_not_grow_with_groups(self):
+        few = ['group%d' % i for i in range(3)]
+        many = ['other%d' % i for i in range(100)]
+        user2 = User.objects.create(username='user2')
+        with self.assertNumQueries(14):
+            self.middleware.update_user_groups(self._request(few), self.user)
+        with self.assertNumQueries(13):
+            self.middleware.update_user_groups(self._request(many), user2)
+        self.assertEqual(self._group_names(), set(few))
+        self.assertEqual(user2.groups.count(), 100)
+
+    def test_known_groups_cost_no_queries(self):
+        group = Group.objects.create(name='a')
+        self.catalog.get_ids(['a'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.catalog.get_ids(['a']), {'a': group.pk})
+        # Only the through table is touched.
+        with self.assertNumQueries(8):
+            self.middleware.update_user_groups(self._request(['a']), self.user)
+
+    def test_deleted_group_is_discarded(self):
+        group_id = self.catalog.get_ids(['a'])['a']
+        Group.objects.get(pk=group_id).delete()
+        self.middleware.update_user_groups(self._request(['a']), self.user)
+        self.assertEqual(self._group_names(), {'a'})
+        self.assertNotEqual(Group.objects.get(name='a').pk, group_id)
+
+    def test_group_deleted_by_another_process(self):
+        other_process = GroupCatalog()
+        group_id = Group.objects.create(name='a').pk
+        self.assertEqual(other_process.get_ids(['a']), {'a': group_id})
+        # Only the catalog of this process receives the signal.
+        Group.objects.get(pk=group_id).delete()
+        self.assertNotEqual(other_process.get_ids(['a'])['a'], group_id)
+
+    def test_renamed_group_is_discarded(self):
+        group = Group.objects.create(name='a')
+        self.catalog.get_ids(['a'])
+        group.name = 'b'
+        group.save()
+        self.assertEqual(self.catalog.get_ids(['b']), {'b': group.pk})
+        self.assertNotEqual(self.catalog.get_ids(['a'])['a'], group.pk)
+
+    def test_shared_catalog(self):
+        Group.objects.create(name='a')
+        Group.objects.create(name='b')
+        with self.settings(SHIBAUTH_CACHE_ALIAS='default'):
+            catalog = get_group_catalog()
+            group_ids = catalog.get_ids(['a', 'b'])
+            self.assertEqual(caches['default'].get(GroupCatalog.cache_key), group_ids)
+            with self.assertNumQueries(0):
+                self.assertEqual(GroupCatalog(caches['default']).get_ids(['a']), {'a': group_ids['a']})
+            Group.objects.get(name='a').delete()
+            self.assertIsNone(caches['default'].get(GroupCatalog.cache_key))
+
+    def test_requires_shared_cache(self):
+        local = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+        with self.settings(CACHES=dict(SHARED_DEFAULT_CACHES, default=local)):
+            self.assertIsNone(get_group_catalog())
+            with self.assertRaises(ImproperlyConfigured):
+                check_group_catalog()
+        check_group_catalog()
+
+
+@mock.patch('shibauth_rit.groups.bulk_create_ignores_conflicts', False)
+class TestBulkCreateIgnoringConflicts(TestCase):
+
+    def test_existing_rows_are_skipped(self):
+        Group.objects.create(name='a')
+        bulk_create_ignoring_conflicts(Group, [Group(name='a'), Group(name='b')])
+        self.assertEqual(sorted(Group.objects.values_list('name', flat=True)), ['a', 'b'])
+
+    def test_other_errors_are_raised(self):
+        Group.objects.create(name='a')
+        with mock.patch.object(Group, 'save', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                bulk_create_ignoring_conflicts(Group, [Group(name='a'), Group(name='b')])
+
+
+class TestGroupCatalogTransactions(TransactionTestCase):
+
+    def test_created_groups_are_added_on_commit(self):
+        catalog = GroupCatalog()
+        group_id = catalog.get_ids(['a'])['a']
+        self.assertEqual(catalog._ids, {'a': group_id})
+
+    def test_rolled_back_groups_are_not_added(self):
+        catalog = GroupCatalog()
+        try:
+            with transaction.atomic():
+                catalog.get_ids(['a'])
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(catalog._ids, {})
+        self.assertFalse(Group.objects.exists())
+
+
+@override_settings(SHIBAUTH_EXEMPT_PATHS=['/health/', '/static/', r'^/api/v\d+/'])
+class TestExemptPaths(TestCase):
+
+    def test_exempt_paths_skip_session(self):
+        # Log in, so that looking at the session would query the database.
+        self.client.get('/', **settings.SAMPLE_HEADERS)
+        headers = dict(settings.SAMPLE_HEADERS, uid='someoneelse')
+        for path in ('/health/', '/static/css/site.css', '/api/v2/users/'):
+            with self.assertNumQueries(0):
+                self.client.get(path, **headers)
+        self.assertFalse(User.objects.filter(username='someoneelse').exists())
+
+    def test_other_paths_are_authenticated(self):
+        self.client.get('/api/users/', **settings.SAMPLE_HEADERS)
+        self.assertTrue(User.objects.filter(username='rrcdis1').exists())
+
+    def test_compile_paths(self):
+        pattern = compile_paths(['/a.b/', r'^/c/\d+$'])
+        self.assertTrue(pattern.match('/a.b/c'))
+        self.assertFalse(pattern.match('/axb/'))
+        self.assertFalse(pattern.match('/x/a.b/'))
+        self.assertTrue(pattern.match('/c/12'))
+        self.assertFalse(pattern.match('/c/12/'))
+        self.assertIsNone(compile_paths([]))
+
+    def test_matcher_follows_setting_changes(self):
+        with self.settings(SHIBAUTH_EXEMPT_PATHS=[]):
+            self.assertIsNone(get_path_matcher('SHIBAUTH_EXEMPT_PATHS'))
+        self.assertIs(get_path_matcher('SHIBAUTH_EXEMPT_PATHS'), get_path_matcher('SHIBAUTH_EXEMPT_PATHS'))
+
+
+class TestMockHeaders(TestCase):
+
+    def test_disabled_without_debug(self):
+        with self.settings(SHIBAUTH_MOCK_HEADERS={'uid': 'rrcdis1'}):
+            with mock.patch('shibauth_rit.middleware.logger') as logger:
+                with self.assertRaises(MiddlewareNotUsed):
+                    ShibauthRitMockHeadersMiddleware()
+        self.assertTrue(logger.warning.called)
+
+    @override_settings(DEBUG=True)
+    def test_disabled_without_headers(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ShibauthRitMockHeadersMiddleware()
+
+    @override_settings(DEBUG=True, SHIBAUTH_MOCK_HEADERS={'uid': 'rrcdis1', 'mail': 'rrcdis1@rit.edu'})
+    def test_fixed_headers(self):
+        request = RequestFactory().get('/')
+        ShibauthRitMockHeadersMiddleware().process_request(request)
+        self.assertEqual(request.META['uid'], 'rrcdis1')
+        self.assertEqual(request.META['mail'], 'rrcdis1@rit.edu')
+        self.assertEqual(request.META[settings.SHIBAUTH_REMOTE_USER_HEADER], 'rrcdis1')
+
+    @override_settings(DEBUG=True, SHIBAUTH_MOCK_HEADERS=3, SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'])
+    def test_synthetic_users(self):
+        middleware = ShibauthRitMockHeadersMiddleware()
+        usernames = []
+        for _ in range(4):
+            request = RequestFactory().get('/')
+            middleware.process_request(request)
+            usernames.append(request.META['uid'])
+        self.assertEqual(usernames, ['mockuser0', 'mockuser1', 'mockuser2', 'mockuser0'])
+        self.assertEqual(request.META['ritEduMemberOfUid'], 'mock-everyone;mock-group0')
+        request = RequestFactory().get('/', HTTP_X_SHIBAUTH_MOCK_USER='2')
+        middleware.process_request(request)
+        self.assertEqual(request.META['uid'], 'mockuser2')
+
+    def test_headers_from_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'headers.json')
+        with open(path, 'w') as f:
+            json.dump([{'uid': 'first'}, {'uid': 'second'}], f)
+        with self.settings(DEBUG=True, SHIBAUTH_MOCK_HEADERS=path):
+            middleware = ShibauthRitMockHeadersMiddleware()
+        self.assertEqual([profile['uid'] for profile in middleware.profiles], ['first', 'second'])
+
+    @override_settings(DEBUG=True, SHIBAUTH_MOCK_HEADERS=2)
+    @modify_settings(**{MIDDLEWARE_SETTING: {'prepend': 'shibauth_rit.middleware.ShibauthRitMockHeadersMiddleware'}})
+    def test_login(self):
+        self.client.get(reverse('shibauth_rit:shibauth_info'))
+        self.client.get(reverse('shibauth_rit:shibauth_info'))
+        self.assertEqual(
+            sorted(User.objects.values_list('username', flat=True)), ['mockuser0', 'mockuser1'])
+
+
+class TestSessionAttributes(TestCase):
+
+    def setUp(self):
+        self.middleware = ShibauthRitMiddleware()
+        self.shib_meta = {'username': ('rrcdis1', True), 'email': ('rrcdis1@rit.edu', False)}
+
+    def _request(self):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        return request
+
+    def test_stores_attributes(self):
+        request = self._request()
+        self.middleware.store_session_attributes(request, self.shib_meta)
+        self.assertTrue(request.session.modified)
+        self.assertEqual(request.session['shib'], self.shib_meta)
+
+    @override_settings(SHIBAUTH_COMPACT_SESSION=True, SHIBAUTH_SESSION_ATTRIBUTES=['email'])
+    def test_compact_allowlist(self):
+        request = self._request()
+        self.middleware.store_session_attributes(request, self.shib_meta)
+        self.assertEqual(request.session['shib'], {'email': 'rrcdis1@rit.edu'})
+
+
+class AtomicMiddleware(ShibauthRitMiddleware):
+    atomic = []
+    fail = False
+
+    def make_profile(self, user, shib_meta):
+        self.atomic.append(transaction.get_connection().in_atomic_block)
+        if self.fail:
+            raise ValueError('profile failed')
+
+
+@override_settings(SHIBAUTH_ATOMIC_LOGIN=True, SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'])
+class TestAtomicLogin(TransactionTestCase):
+
+    def setUp(self):
+        del AtomicMiddleware.atomic[:]
+        AtomicMiddleware.fail = False
+
+    def login(self):
+        request = RequestFactory().get('/', **settings.SAMPLE_HEADERS)
+        SessionMiddleware().process_request(request)
+        AuthenticationMiddleware().process_request(request)
+        AtomicMiddleware().process_request(request)
+        return request
+
+    def test_login_in_one_transaction(self):
+        request = self.login()
+        self.assertEqual(AtomicMiddleware.atomic, [True])
+        self.assertTrue(request.user.is_authenticated())
+        self.assertEqual(request.user.groups.count(), 3)
+
+    def test_not_atomic_by_default(self):
+        with self.settings(SHIBAUTH_ATOMIC_LOGIN=False):
+            self.login()
+        self.assertEqual(AtomicMiddleware.atomic, [False])
+
+    @override_settings(SHIBAUTH_USER_CACHE_SIZE=10)
+    def test_failed_login_leaves_nothing(self):
+        AtomicMiddleware.fail = True
+        request = RequestFactory().get('/', **settings.SAMPLE_HEADERS)
+        SessionMiddleware().process_request(request)
+        AuthenticationMiddleware().process_request(request)
+        with self.assertRaises(ValueError):
+            AtomicMiddleware().process_request(request)
+        self.assertFalse(request.user.is_authenticated())
+        self.assertNotIn('_auth_user_id', request.session)
+        self.assertEqual(User.objects.count(), 0)
+        self.assertEqual(Group.objects.count(), 0)
+        self.assertEqual(get_user_cache().stats()['size'], 0)
+
+
+@override_settings(SHIBAUTH_GROUP_SYNC_INTERVAL=300, SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'])
+class TestGroupSyncInterval(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def login(self, groups):
+        self.client.logout()
+        self.client.get('/', **dict(settings.SAMPLE_HEADERS, ritEduMemberOfUid=groups))
+        return sorted(User.objects.get(username='rrcdis1').groups.values_list('name', flat=True))
+
+    def test_skipped_within_interval(self):
+        self.assertEqual(self.login('a;b'), ['a', 'b'])
+        self.assertEqual(self.login('c'), ['a', 'b'])
+        caches['default'].clear()
+        self.assertEqual(self.login('c'), ['c'])
+
+    def test_forced(self):
+        self.login('a;b')
+        with mock.patch.object(ShibauthRitMiddleware, 'force_group_sync', return_value=True) as force:
+            self.assertEqual(self.login('c'), ['c'])
+        self.assertTrue(force.called)
+
+    def test_disabled(self):
+        with self.settings(SHIBAUTH_GROUP_SYNC_INTERVAL=None):
+            self.login('a;b')
+            self.assertEqual(self.login('c'), ['c'])
+
+
+@override_settings(SHIBAUTH_STATELESS_PATHS=['/api/'], SHIBAUTH_USER_CACHE_SIZE=10)
+class TestStatelessPaths(TestCase):
+
+    def setUp(self):
+        # The cache outlives the rolled back test transactions.
+        reset_user_cache('SHIBAUTH_USER_CACHE_SIZE')
+
+    def request(self, path='/api/users/', **headers):
+        request = RequestFactory().get(path, **dict(settings.SAMPLE_HEADERS, **headers))
+        SessionMiddleware().process_request(request)
+        AuthenticationMiddleware().process_request(request)
+        ShibauthRitMiddleware().process_request(request)
+        return request
+
+    def test_user_without_session(self):
+        request = self.request()
+        self.assertTrue(request.user.is_authenticated())
+        self.assertFalse(request.session.accessed)
+        self.assertIsNone(User.objects.get().last_login)
+
+    def test_cached_user(self):
+        user = self.request().user
+        with self.assertNumQueries(0):
+            request = self.request()
+        self.assertEqual(request.user.pk, user.pk)
+
+    def test_no_session_cookie(self):
+        response = self.client.get('/api/users/', **settings.SAMPLE_HEADERS)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+    def test_missing_header(self):
+        request = RequestFactory().get('/api/users/')
+        SessionMiddleware().process_request(request)
+        AuthenticationMiddleware().process_request(request)
+        ShibauthRitMiddleware().process_request(request)
+        self.assertFalse(request.user.is_authenticated())
+        self.assertFalse(request.session.accessed)
+
+    @override_settings(SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'])
+    def test_groups_without_interval(self):
+        request = self.request()
+        self.assertEqual(request.user.groups.count(), 3)
+        # Only the fingerprint of the last synchronization is read.
+        with self.assertNumQueries(1):
+            self.request()
+
+    @override_settings(SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'], SHIBAUTH_GROUP_SYNC_INTERVAL=300)
+    def test_groups(self):
+        caches['default'].clear()
+        request = self.request()
+        self.assertEqual(request.user.groups.count(), 3)
+        with self.assertNumQueries(0):
+            self.request()
+
+    def test_other_paths_use_the_session(self):
+        request = self.request('/accounts/')
+        self.assertTrue(request.session.accessed)
+        self.assertIsNotNone(User.objects.get().last_login)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import threading
+import time
+
+# Third Party Library Imports
+import mock
+import requests
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+from django.utils.six.moves import BaseHTTPServer
+
+# First Party Library Imports
+from shibauth_rit.compat import reverse
+from shibauth_rit.notifier import LogoutNotifier, get_logout_notifier
+
+
+class IdentityProviderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        server.requests.append(self.path)
+        time.sleep(server.delay)
+        status = server.statuses.pop(0) if server.statuses else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class IdentityProviderMixin(object):
+    """
+    Run a stand-in identity provider on a local port.
+    """
+
+    def setUp(self):
+        super(IdentityProviderMixin, self).setUp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), IdentityProviderHandler)
+        self.server.requests = []
+        self.server.statuses = []
+        self.server.delay = 0
+        self.url = 'http://127.0.0.1:%d/logout.html' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(IdentityProviderMixin, self).tearDown()
+
+
+class LogoutNotifierTest(IdentityProviderMixin, SimpleTestCase):
+
+    def test_notify(self):
+        notifier = LogoutNotifier(self.url)
+        self.assertTrue(notifier.notify())
+        notifier.pool.join()
+        self.assertEqual(self.server.requests, ['/logout.html'])
+        notifier.close()
+
+    def test_retries_server_errors(self):
+        self.server.statuses = [503, 502]
+        notifier = LogoutNotifier(self.url, retries=2)
+        notifier.notify()
+        notifier.pool.join()
+        self.assertEqual(len(self.server.requests), 3)
+        notifier.close()
+
+    def test_gives_up_after_retries(self):
+        self.server.statuses = [503, 503, 503]
+        notifier = LogoutNotifier(self.url, retries=1)
+        with mock.patch('shibauth_rit.notifier.logger') as logger:
+            notifier.notify()
+            notifier.pool.join()
+        self.assertEqual(logger.warning.call_count, 1)
+        self.assertEqual(len(self.server.requests), 2)
+        notifier.close()
+
+    def test_client_errors_are_not_retried(self):
+        self.server.statuses = [404]
+        notifier = LogoutNotifier(self.url, retries=2)
+        with mock.patch('shibauth_rit.notifier.logger') as logger:
+            notifier.notify()
+            notifier.pool.join()
+        self.assertEqual(logger.warning.call_count, 1)
+        self.assertEqual(len(self.server.requests), 1)
+        notifier.close()
+
+    def test_retries_connection_errors(self):
+        notifier = LogoutNotifier(self.url, retries=2)
+        with mock.patch.object(notifier.session, 'post', side_effect=requests.ConnectionError) as post:
+            with mock.patch('shibauth_rit.notifier.logger') as logger:
+                notifier.post()
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(logger.warning.call_count, 1)
+        notifier.close()
+
+    def test_queue_is_bounded(self):
+        self.server.delay = 0.2
+        notifier = LogoutNotifier(self.url, workers=1, max_queue_size=1)
+        results = [notifier.notify() for _ in range(5)]
+        self.assertFalse(all(results))
+        notifier.pool.join()
+        self.assertEqual(len(self.server.requests), results.count(True))
+        notifier.close()
+
+    def test_disabled(self):
+        with self.settings(SHIBAUTH_LOGOUT_NOTIFY_URL=None):
+            self.assertIsNone(get_logout_notifier())
+
+    def test_follows_settings(self):
+        with self.settings(SHIBAUTH_LOGOUT_NOTIFY_URL=self.url, SHIBAUTH_LOGOUT_NOTIFY_TIMEOUT=1):
+            notifier = get_logout_notifier()
+            self.assertIs(notifier, get_logout_notifier())
+            self.assertEqual(notifier.url, self.url)
+            self.assertEqual(notifier.timeout, 1)
+
+
+class LogoutViewNotifyTest(IdentityProviderMixin, TestCase):
+
+    def test_logout_does_not_wait_for_identity_provider(self):
+        self.server.delay = 1
+        with self.settings(SHIBAUTH_LOGOUT_NOTIFY_URL=self.url):
+            start = time.time()
+            response = self.client.get(reverse('shibauth_rit:shibauth_logout'), **settings.SAMPLE_HEADERS)
+            self.assertLess(time.time() - start, self.server.delay)
+            self.assertEqual(response.status_code, 302)
+            get_logout_notifier().pool.join()
+        self.assertEqual(self.server.requests, ['/logout.html'])
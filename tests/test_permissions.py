@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Third Party Library Imports
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory, TestCase, override_settings
+
+# First Party Library Imports
+from shibauth_rit.middleware import ShibauthRitMiddleware
+from shibauth_rit.groups import sync_user_groups
+from shibauth_rit.permissions import (SESSION_KEY, USER_VERSION_KEY, check_permission_snapshot,
+                                      get_permissions_version, permission_snapshot_enabled)
+
+
+@override_settings(
+    SHIBAUTH_PERMISSION_SNAPSHOT=True,
+    SHIBAUTH_CACHE_ALIAS='shared',
+    SHIBAUTH_GROUP_ATTRIBUTES=['ritEduMemberOfUid'],
+    AUTHENTICATION_BACKENDS=[
+        'shibauth_rit.backends.ShibauthRitBackend',
+        'shibauth_rit.backends.ShibauthRitPermissionBackend',
+    ],
+)
+class TestPermissionSnapshot(TestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.group = Group.objects.create(name='forklift-operators')
+        self.permission = Permission.objects.get(codename='change_user')
+        self.group.permissions.add(self.permission)
+
+    def request(self, session_key=None):
+        request = RequestFactory().get('/', **settings.SAMPLE_HEADERS)
+        if session_key:
+            request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+        SessionMiddleware().process_request(request)
+        AuthenticationMiddleware().process_request(request)
+        ShibauthRitMiddleware().process_request(request)
+        if request.session.modified:
+            request.session.save()
+        return request
+
+    def test_snapshot_on_login(self):
+        request = self.request()
+        snapshot = request.session[SESSION_KEY]
+        self.assertEqual(snapshot['group_permissions'], ['auth.change_user'])
+        self.assertIn('forklift-operators', snapshot['groups'])
+        with self.assertNumQueries(0):
+            self.assertTrue(request.user.has_perm('auth.change_user'))
+            self.assertFalse(request.user.has_perm('auth.delete_user'))
+            self.assertEqual(request.user.get_all_permissions(), set(['auth.change_user']))
+
+    def test_reused_when_authenticated(self):
+        session_key = self.request().session.session_key
+        # The session and the user are read, the snapshot is not taken again.
+        with self.assertNumQueries(2):
+            request = self.request(session_key)
+            self.assertTrue(request.user.has_perm('auth.change_user'))
+
+    def test_permission_change_takes_new_snapshot(self):
+        session_key = self.request().session.session_key
+        self.group.permissions.add(Permission.objects.get(codename='delete_user'))
+        request = self.request(session_key)
+        with self.assertNumQueries(0):
+            self.assertTrue(request.user.has_perm('auth.delete_user'))
+
+    def test_object_permissions_are_not_snapshotted(self):
+        request = self.request()
+        self.assertFalse(request.user.has_perm('auth.change_user', obj=request.user))
+
+    def test_disabled(self):
+        with self.settings(SHIBAUTH_PERMISSION_SNAPSHOT=False):
+            request = self.request()
+            self.group.permissions.add(Permission.objects.get(codename='delete_user'))
+        self.assertNotIn(SESSION_KEY, request.session)
+        self.assertFalse(hasattr(request.user, '_shibauth_permissions'))
+        self.assertTrue(User.objects.get(username='rrcdis1').has_perm('auth.delete_user'))
+
+    def user_version(self, user):
+        return caches['shared'].get(USER_VERSION_KEY % user.pk)
+
+    def test_group_sync_takes_new_snapshot(self):
+        user = self.request().user
+        version = self.user_version(user)
+        sync_user_groups(user, ['historyintegrator'])
+        self.assertNotEqual(self.user_version(user), version)
+        version = self.user_version(user)
+        sync_user_groups(user, ['historyintegrator'])
+        self.assertEqual(self.user_version(user), version)
+
+    def test_group_sync_keeps_other_snapshots(self):
+        session_key = self.request().session.session_key
+        other = User.objects.create(username='other')
+        version = get_permissions_version()
+        sync_user_groups(other, ['forklift-operators'])
+        self.assertEqual(get_permissions_version(), version)
+        self.assertIsNotNone(self.user_version(other))
+        # The session and the user are read, the snapshot is not taken again.
+        with self.assertNumQueries(2):
+            self.request(session_key)
+
+    def test_membership_change_takes_new_snapshot(self):
+        request = self.request()
+        session_key = request.session.session_key
+        request.user.groups.remove(self.group)
+        request = self.request(session_key)
+        with self.assertNumQueries(0):
+            self.assertFalse(request.user.has_perm('auth.change_user'))
+
+    def test_requires_shared_cache(self):
+        with self.settings(SHIBAUTH_CACHE_ALIAS=None):
+            self.assertFalse(permission_snapshot_enabled())
+            with self.assertRaises(ImproperlyConfigured):
+                check_permission_snapshot()
+            request = self.request()
+        self.assertNotIn(SESSION_KEY, request.session)
+        check_permission_snapshot()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# Standard Library Imports
+import json
+
+# Third Party Library Imports
+import mock
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.db import transaction
+from django.test import RequestFactory, TransactionTestCase, override_settings
+
+# First Party Library Imports
+from shibauth_rit import profiles
+from shibauth_rit.middleware import ShibauthRitMiddleware
+
+
+class ProfileMiddleware(ShibauthRitMiddleware):
+    profiles = []
+
+    def make_profile(self, user, shib_meta):
+        self.profiles.append((user.username, shib_meta['email'][0]))
+
+
+class RecordingExecutor(profiles.BaseProfileExecutor):
+
+    def __init__(self):
+        self.submitted = []
+        self.in_atomic_block = []
+
+    def submit(self, middleware_path, user_pk, shib_meta):
+        self.submitted.append((middleware_path, user_pk, shib_meta))
+        self.in_atomic_block.append(transaction.get_connection('other').in_atomic_block)
+
+
+@override_settings(SHIBAUTH_ATTRIBUTE_MAP={'uid': (True, 'username'), 'mail': (False, 'email')})
+class TestDeferredProfiles(TransactionTestCase):
+    multi_db = True
+    databases = {'default', 'other'}
+
+    def setUp(self):
+        del ProfileMiddleware.profiles[:]
+
+    def login(self):
+        request = RequestFactory().get('/', **settings.SAMPLE_HEADERS)
+        SessionMiddleware().process_request(request)
+        AuthenticationMiddleware().process_request(request)
+        ProfileMiddleware().process_request(request)
+        return request
+
+    def test_not_deferred_by_default(self):
+        user = self.login().user
+        self.assertEqual(ProfileMiddleware.profiles, [(user.username, 'rrcdis1@rit.edu')])
+
+    @override_settings(SHIBAUTH_PROFILE_EXECUTOR='tests.test_profiles.RecordingExecutor')
+    def test_deferred_until_commit(self):
+        executor = profiles.get_profile_executor()
+        with transaction.atomic():
+            user = self.login().user
+            self.assertEqual(executor.submitted, [])
+        self.assertEqual(ProfileMiddleware.profiles, [])
+        [(middleware_path, user_pk, shib_meta)] = executor.submitted
+        self.assertEqual(middleware_path, 'tests.test_profiles.ProfileMiddleware')
+        self.assertEqual(user_pk, user.pk)
+        self.assertEqual(shib_meta['email'], ['rrcdis1@rit.edu', False])
+        self.assertEqual(json.loads(json.dumps(shib_meta)), shib_meta)
+
+        profiles.make_profile(middleware_path, user_pk, shib_meta)
+        self.assertEqual(ProfileMiddleware.profiles, [(user.username, 'rrcdis1@rit.edu')])
+
+    @override_settings(
+        SHIBAUTH_PROFILE_EXECUTOR='tests.test_profiles.RecordingExecutor', SHIBAUTH_DATABASE='other')
+    def test_deferred_until_commit_on_login_database(self):
+        executor = profiles.get_profile_executor()
+        with transaction.atomic(using='other'):
+            self.login()
+            self.assertEqual(executor.submitted, [])
+        self.assertEqual(len(executor.submitted), 1)
+
+    @override_settings(
+        SHIBAUTH_PROFILE_EXECUTOR='tests.test_profiles.RecordingExecutor',
+        SHIBAUTH_ATOMIC_LOGIN=True,
+        SHIBAUTH_DATABASE='other',
+    )
+    def test_deferred_until_atomic_login_commits(self):
+        executor = profiles.get_profile_executor()
+        self.login()
+        self.assertEqual(executor.in_atomic_block, [False])
+
+    @override_settings(SHIBAUTH_PROFILE_EXECUTOR='tests.test_profiles.RecordingExecutor')
+    def test_not_submitted_on_rollback(self):
+        executor = profiles.get_profile_executor()
+        try:
+            with transaction.atomic():
+                self.login()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(executor.submitted, [])
+
+    @override_settings(SHIBAUTH_PROFILE_EXECUTOR=(
+        'shibauth_rit.profiles.ThreadPoolProfileExecutor', {'workers': 1}))
+    def test_thread_pool(self):
+        user = self.login().user
+        profiles.get_profile_executor().pool.join()
+        self.assertEqual(ProfileMiddleware.profiles, [(user.username, 'rrcdis1@rit.edu')])
+
+    def test_deleted_user(self):
+        with mock.patch.object(profiles, 'logger') as logger:
+            profiles.make_profile('tests.test_profiles.ProfileMiddleware', 1234, {})
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(ProfileMiddleware.profiles, [])
@@ -3,7 +3,7 @@
 # Third Party Library Imports
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 # First Party Library Imports
 from shibauth_rit.compat import reverse
@@ -52,3 +52,30 @@ class ShibLoginViewTest(TestCase):
         with self.settings(SHIBAUTH_GROUP_ATTRIBUTES=[]):
             res = self.client.get(reverse('shibauth_rit:shibauth_login'), **settings.SAMPLE_HEADERS)
             self.assertEqual(res.status_code, 302)
+
+
+@override_settings(SHIBAUTH_FORCE_REAUTH_COOKIE='shib_force_reauth', SHIBAUTH_GROUP_ATTRIBUTES=[])
+class ForceReauthCookieTest(TestCase):
+
+    def test_logout_sets_cookie(self):
+        self.client.get(reverse('shibauth_rit:shibauth_info'), **settings.SAMPLE_HEADERS)
+        self.client.get(reverse('shibauth_rit:shibauth_logout'), **settings.SAMPLE_HEADERS)
+        self.assertIn('shib_force_reauth', self.client.cookies)
+        self.assertNotIn(settings.SHIBAUTH_LOGOUT_SESSION_KEY, self.client.session)
+        # The headers are ignored until the user logs in again.
+        resp = self.client.get(reverse('shibauth_rit:shibauth_info'), **settings.SAMPLE_HEADERS)
+        self.assertEqual(resp.status_code, 302)
+
+        login = self.client.get(reverse('shibauth_rit:shibauth_login'), **settings.SAMPLE_HEADERS)
+        self.assertEqual(login.cookies['shib_force_reauth'].value, '')
+        resp = self.client.get(reverse('shibauth_rit:shibauth_info'), **settings.SAMPLE_HEADERS)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_unsigned_cookie_is_ignored(self):
+        self.client.cookies['shib_force_reauth'] = '1'
+        resp = self.client.get(reverse('shibauth_rit:shibauth_info'), **settings.SAMPLE_HEADERS)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_login_without_cookie_sets_no_cookie(self):
+        login = self.client.get(reverse('shibauth_rit:shibauth_login'))
+        self.assertNotIn('shib_force_reauth', login.cookies)